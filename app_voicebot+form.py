@@ -1,20 +1,25 @@
 import os
 import re
-import csv
 import json
+import time
+import asyncio
 import urllib.parse
-import requests
-from pathlib import Path
 from datetime import datetime
 from fastapi import FastAPI, Form, Request, HTTPException, Body
-from fastapi.responses import PlainTextResponse, Response
+from fastapi.responses import PlainTextResponse, Response, FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from twilio.twiml.voice_response import VoiceResponse, Gather
 from dotenv import load_dotenv
 
-# ==== Google Sheets ====
-import gspread
-from google.oauth2.service_account import Credentials
+from tts_cache import TTSCache
+from tts_prompts import PromptRegistry, STATIC_CACHE_CONTROL
+from tts_providers import TTSError
+from tts_engine import build_engine
+from metrics import LatencyStats
+from session_store import build_session_store
+from call_outcomes import CallOutcomeLog, TERMINAL_CALL_STATUSES
+from lead_queue import LeadQueue
+from lead_store import LeadStore
 
 # =========================
 # Config & storage
@@ -24,18 +29,23 @@ load_dotenv()
 PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "http://localhost:3000").rstrip("/")
 ELEVEN_API_KEY = os.getenv("ELEVEN_API_KEY", "")
 ELEVEN_VOICE_ID = os.getenv("ELEVEN_VOICE_ID", "21m00Tcm4TlvDq8ikWAM")
+# 1 = /tts manda l'audio a Twilio mentre viene sintetizzato (solo cache miss)
+TTS_STREAMING = os.getenv("TTS_STREAMING", "0") == "1"
 
 # Google Sheets ENV
 GOOGLE_SHEETS_ID = os.getenv("GOOGLE_SHEETS_ID", "").strip()
 SHEET_NAME = os.getenv("SHEET_NAME", "Sheet1").strip() or "Sheet1"
 
-# === Inizializza Google Sheets client ===
-GS_SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
-GS_CREDS = Credentials.from_service_account_file("service_account_Sheet.json", scopes=GS_SCOPES)
-gclient = gspread.authorize(GS_CREDS)
 
 app = FastAPI()
 
+# Cache audio TTS su disco (data/tts_cache)
+tts_cache = TTSCache()
+# Motore TTS: provider in ordine di preferenza (TTS_PROVIDERS), hedging e failover
+tts_engine = build_engine(tts_cache, "elevenlabs,google,local", ELEVEN_API_KEY, ELEVEN_VOICE_ID)
+# Time-to-first-byte delle sintesi (cache miss), streaming vs risposta bufferizzata
+tts_ttfb = {"stream": LatencyStats(), "buffered": LatencyStats()}
+
 # === Abilita CORS per la landing su systeme.io ===
 app.add_middleware(
     CORSMiddleware,
@@ -45,16 +55,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-sessions = {}  # in-RAM (in produzione: Redis/DB)
+# Sessioni IVR: in RAM con TTL, oppure Redis per più worker (SESSION_STORE)
+session_store = build_session_store()
+# Esiti chiamate (data/call_outcomes.jsonl), scritti dallo StatusCallback Twilio
+call_outcomes = CallOutcomeLog()
 FIRST_STEP = "service"
 
-# === CSV locale come backup
-CSV_PATH = Path("data/leads.csv")
-CSV_FIELDS = [
-    "vertical", "city", "service", "zone", "timing",
-    "phone", "consent", "source", "timestamp", "stripe_price_id", "€",
-    "status", "sent_at", "sold_at"
-]
 
 
 PRICE_MAP = {
@@ -95,62 +101,68 @@ STRIPE_PRICE_MAP = {
 def get_stripe_price_id(service: str, timing: str) -> str:
     return STRIPE_PRICE_MAP.get(service, {}).get(timing, "")
 
-def save_lead_to_csv(lead: dict):
-    CSV_PATH.parent.mkdir(parents=True, exist_ok=True)
-    file_exists = CSV_PATH.exists()
-    with CSV_PATH.open(mode="a", newline="", encoding="utf-8-sig") as f:
-        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
-        if not file_exists:
-            writer.writeheader()
-        writer.writerow({k: lead.get(k, "") for k in CSV_FIELDS})
-
-# ---------- Google Sheets helper ----------
-def save_lead_to_gsheet(lead: dict):
-    if not GOOGLE_SHEETS_ID:
-        raise RuntimeError("GOOGLE_SHEETS_ID non impostato nel .env")
-    try:
-        sh = gclient.open_by_key(GOOGLE_SHEETS_ID)
-        try:
-            ws = sh.worksheet(SHEET_NAME)
-        except gspread.WorksheetNotFound:
-            ws = sh.add_worksheet(title=SHEET_NAME, rows="100", cols=str(len(CSV_FIELDS)))
-            ws.append_row(CSV_FIELDS, value_input_option="USER_ENTERED")
-
-        row = [
-            lead.get("vertical", ""),
-            lead.get("city", ""),
-            lead.get("service", ""),
-            lead.get("zone", ""),
-            lead.get("timing", ""),
-            lead.get("phone", ""),
-            str(lead.get("consent", "")),
-            lead.get("source", ""),
-            lead.get("timestamp", ""),
-            lead.get("stripe_price_id", ""),
-            lead.get("€", ""),
-            lead.get("status", ""),
-            lead.get("sent_at", ""),
-            lead.get("sold_at", "")
-        ]
-
-        if ws.row_count == 0 or ws.acell("A1").value is None:
-            ws.append_row(CSV_FIELDS, value_input_option="USER_ENTERED")
-        ws.append_row(row, value_input_option="USER_ENTERED")
-        print("LEAD SALVATA SU GOOGLE SHEET:", row)
-    except Exception as e:
-        print("ERRORE SALVATAGGIO GOOGLE SHEET:", e)
-        raise
+# ---------- Lead store ----------
+# Le lead finiscono nello store locale (data/leads.db); sheet_sync.py le copia sul foglio
+lead_store = LeadStore()
+
+def save_leads(leads: list):
+    lead_ids = lead_store.insert_many(leads)
+    print(f"{len(leads)} LEAD SALVATE (lead_id {lead_ids}):", leads)
+
+# Le lead vengono accettate subito (journal su disco, data/lead_journal.log) e salvate in batch da un thread
+lead_queue = LeadQueue(save_leads)
+
+# ---------- Prompt statici IVR (pre-renderizzati all'avvio) ----------
+PROMPTS = {
+    "greeting": (
+        "Buongiorno. Ti aiuto a ricevere un preventivo gratuito e discreto "
+        "per un’agenzia funebre a Milano. Ti farò poche domande. "
+        "Di cosa hai bisogno: funerale completo, cremazione o trasferimento salma?"
+    ),
+    "service_retry": "Non ho capito bene. Ti serve un funerale, una cremazione o un trasferimento salma?",
+    "ask_zone": "In quale zona o quartiere di Milano serve il servizio?",
+    "zone_retry": "Puoi ripetere la zona di Milano?",
+    "ask_timing": "Serve subito, entro ventiquattro ore, oppure nei prossimi giorni?",
+    "ask_phone": "Perfetto. Mi lasci un numero di telefono per l’invio della stima e la chiamata di conferma?",
+    "phone_retry": "Il numero non sembra valido. Potresti ripeterlo lentamente, per favore?",
+    "ask_consent": "Confermi che possiamo far contattare il tuo numero da un’agenzia autorizzata della tua zona, solo per confermare il preventivo?",
+    "bye_no_consent": "Capito. Non procederò con il contatto. Se cambi idea, puoi richiamarci quando vuoi. Un caro saluto.",
+    "bye_lead_saved": "Grazie. Riceverai a breve una stima indicativa e la chiamata di conferma. Siamo a disposizione ventiquattro ore su ventiquattro.",
+    "bye_fallback": "Grazie per la chiamata. Un saluto.",
+    "twiml_test": "Questo è un test in italiano. Se mi senti, il numero è configurato correttamente.",
+}
+prompts = PromptRegistry(PROMPTS)
+
+# Prompt che possono servire al prossimo turno, per lo step in cui si trova la chiamata
+# (risposta attesa o variante di retry): vengono sintetizzati in anticipo
+NEXT_PROMPTS = {
+    "service": ["ask_zone", "service_retry"],
+    "zone": ["ask_timing", "zone_retry"],
+    "timing": ["ask_phone"],
+    "phone": ["ask_consent", "phone_retry"],
+    "consent": ["bye_lead_saved", "bye_no_consent"],
+}
+
+def prefetch_next(call_sid: str, step: str):
+    prompts.prefetch(call_sid, NEXT_PROMPTS.get(step, []), tts_engine)
 
 # ---------- TTS ElevenLabs helpers ----------
 def tts_url_for(text: str) -> str:
     q = urllib.parse.quote_plus(text)
     return f"{PUBLIC_BASE_URL}/tts?q={q}"
 
+def prompt_url_for(text: str) -> str:
+    """URL statico se il prompt è già pre-renderizzato, altrimenti /tts?q=..."""
+    path = prompts.static_path(text)
+    if path:
+        return f"{PUBLIC_BASE_URL}{path}"
+    return tts_url_for(text)
+
 def speak_in_gather(gather: Gather, text: str):
-    gather.play(tts_url_for(text))
+    gather.play(prompt_url_for(text))
 
 def speak_in_response(resp: VoiceResponse, text: str):
-    resp.play(tts_url_for(text))
+    resp.play(prompt_url_for(text))
 
 def say_and_gather(text: str, action: str = "/voice/handle"):
     resp = VoiceResponse()
@@ -184,40 +196,106 @@ def health():
         "public_base_url": PUBLIC_BASE_URL,
         "eleven_set": bool(ELEVEN_API_KEY),
         "gsheets_set": bool(GOOGLE_SHEETS_ID),
-        "sheet_name": SHEET_NAME
+        "sheet_name": SHEET_NAME,
+        "tts_cache": tts_cache.stats(),
+        "tts_prompts": prompts.stats(),
+        "tts_streaming": TTS_STREAMING,
+        "tts_ttfb": {mode: st.stats() for mode, st in tts_ttfb.items()},
+        "tts_engine": tts_engine.stats(),
+        "sessions": session_store.stats(),
+        "calls": call_outcomes.stats(),
+        "lead_queue": lead_queue.stats(),
+        "lead_store": lead_store.stats(),
     }
 
 @app.post("/twiml-test", response_class=PlainTextResponse)
 async def twiml_test():
     resp = VoiceResponse()
-    speak_in_response(resp, "Questo è un test in italiano. Se mi senti, il numero è configurato correttamente.")
+    speak_in_response(resp, PROMPTS["twiml_test"])
     return PlainTextResponse(str(resp), media_type="text/xml")
 
 # ---------- Endpoint TTS ----------
+async def warm_up_prompts():
+    await prompts.warm_up(tts_engine)
+
+@app.on_event("startup")
+async def warm_up_prompts_on_startup():
+    lead_queue.start()
+    # client condivisi dei provider (es. pool HTTP keep-alive verso ElevenLabs)
+    await tts_engine.start()
+    # in background: il server risponde subito, i prompt non ancora pronti usano /tts?q=
+    app.state.warmup_task = asyncio.create_task(warm_up_prompts())
+
+@app.on_event("shutdown")
+async def close_tts_engine():
+    await tts_engine.aclose()
+    await session_store.aclose()
+    lead_queue.stop()
+
+async def warm_up_cli():
+    await warm_up_prompts()
+    await tts_engine.aclose()
+
+class TTSStreamingResponse(StreamingResponse):
+    """Chiude sempre lo stream TTS (slot di sintesi, single-flight), anche se Twilio
+    chiude la connessione prima che l'iterazione parta."""
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+
 @app.get("/tts")
-def tts(q: str):
-    if not ELEVEN_API_KEY:
-        raise HTTPException(status_code=500, detail="ELEVEN_API_KEY mancante")
+async def tts(q: str):
+    started = time.perf_counter()
     text = (q or "").strip()
     if not text:
         raise HTTPException(status_code=400, detail="Parametro q mancante")
 
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVEN_VOICE_ID}"
-    headers = {
-        "xi-api-key": ELEVEN_API_KEY,
-        "Accept": "audio/mpeg",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "text": text,
-        "model_id": "eleven_multilingual_v2",
-        "voice_settings": {"stability": 0.5, "similarity_boost": 0.8}
-    }
-    r = requests.post(url, headers=headers, json=payload, timeout=20)
-    if r.status_code != 200:
-        raise HTTPException(status_code=502, detail=f"Errore ElevenLabs: {r.status_code} - {r.text[:200]}")
+    cached = tts_engine.cached(text)
+    prompts.record_served(text, cached is not None)
+    if cached:
+        path, provider = cached
+        return FileResponse(path, media_type=provider.media_type)
+
+    try:
+        if TTS_STREAMING and not tts_engine.running(text):
+            # streaming verso Twilio: la riproduzione parte prima che la sintesi finisca
+            body, provider = await tts_engine.open_stream(text, tts_ttfb["stream"], started)
+            return TTSStreamingResponse(body, media_type=provider.media_type)
+        audio, provider = await tts_engine.synthesize(text)
+    except TTSError as e:
+        print("ERRORE TTS:", e)
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    tts_ttfb["buffered"].add(time.perf_counter() - started)
+    return Response(content=audio, media_type=provider.media_type)
+
+# ---------- Prompt statici: URL stabile, cache lunga lato Twilio ----------
+@app.get("/tts/static/{name}/{version}")
+async def tts_static(name: str, version: str):
+    text = prompts.text_for(name)
+    if not text:
+        raise HTTPException(status_code=404, detail="Prompt sconosciuto")
 
-    return Response(content=r.content, media_type="audio/mpeg")
+    cached = tts_engine.cached(text)
+    prompts.record_served(text, cached is not None)
+    if cached:
+        path, provider = cached
+    else:  # es. rimosso dall'eviction
+        try:
+            audio, provider = await tts_engine.synthesize(text)
+        except TTSError as e:
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+
+    # audio di un provider di riserva o URL di una versione vecchia: niente cache lunga
+    # (appena possibile torna la voce principale; la versione vecchia non va fissata per un anno)
+    current = tts_engine.is_primary(provider) and prompts.is_current(name, version)
+    cache_control = STATIC_CACHE_CONTROL if current else "no-cache"
+    headers = {"Cache-Control": cache_control}
+    if cached:
+        return FileResponse(path, media_type=provider.media_type, headers=headers)
+    return Response(content=audio, media_type=provider.media_type, headers=headers)
 
 # =========================
 # Endpoint dal form landing
@@ -268,7 +346,7 @@ async def lead_form(payload: dict = Body(...)):
             "sold_at": ""
         }
 
-        save_lead_to_gsheet(lead)
+        await asyncio.to_thread(lead_queue.put, lead)
         return {"success": True, "lead": lead}
     except Exception as e:
         print("ERRORE /lead/form:", e)
@@ -282,19 +360,22 @@ async def voice_incoming(
     request: Request,
     CallSid: str = Form(...),
 ):
-    get_session(CallSid)
-    text = (
-        "Buongiorno. Ti aiuto a ricevere un preventivo gratuito e discreto "
-        "per un’agenzia funebre a Milano. Ti farò poche domande. "
-        "Di cosa hai bisogno: funerale completo, cremazione o trasferimento salma?"
-    )
-    resp = say_and_gather(text)
+    s = await get_session(CallSid)
+    prefetch_next(CallSid, s["step"])
+    resp = say_and_gather(PROMPTS["greeting"])
     return PlainTextResponse(str(resp), media_type="text/xml")
 
-def get_session(call_sid: str):
-    if call_sid not in sessions:
-        sessions[call_sid] = {"step": FIRST_STEP, "data": {}}
-    return sessions[call_sid]
+async def get_session(call_sid: str):
+    s = await session_store.get(call_sid)
+    if s is None:
+        s = {"step": FIRST_STEP, "data": {}, "started_at": time.time()}
+        await session_store.save(call_sid, s)
+    return s
+
+async def finish_session(call_sid: str, s: dict, outcome: str):
+    """Il bot ha chiuso la chiamata: l'esito resta in sessione finché arriva lo status 'completed'."""
+    s["outcome"] = outcome
+    await session_store.save(call_sid, s)
 
 @app.post("/voice/handle", response_class=PlainTextResponse)
 async def voice_handle(
@@ -302,14 +383,18 @@ async def voice_handle(
     CallSid: str = Form(...),
     SpeechResult: str = Form(default=""),
 ):
-    s = get_session(CallSid)
+    s = await get_session(CallSid)
 
-    def _advance_and_say(next_step: str, text: str):
+    async def _advance_and_say(next_step: str, text: str):
         s["step"] = next_step
+        await session_store.save(CallSid, s)
+        prefetch_next(CallSid, next_step)
         return PlainTextResponse(str(say_and_gather(text)), media_type="text/xml")
 
-    def _repeat(text: str, same_step: str):
+    async def _repeat(text: str, same_step: str):
         s["step"] = same_step
+        await session_store.save(CallSid, s)
+        prefetch_next(CallSid, same_step)
         return PlainTextResponse(str(say_and_gather(text)), media_type="text/xml")
 
     tclean = (SpeechResult or "").lower()
@@ -323,16 +408,16 @@ async def voice_handle(
         elif "trasfer" in tclean or "salma" in tclean:
             s["data"]["service"] = "trasferimento"
         else:
-            return _repeat("Non ho capito bene. Ti serve un funerale, una cremazione o un trasferimento salma?", "service")
-        return _advance_and_say("zone", "In quale zona o quartiere di Milano serve il servizio?")
+            return await _repeat(PROMPTS["service_retry"], "service")
+        return await _advance_and_say("zone", PROMPTS["ask_zone"])
 
     # 2) Zona
     if s["step"] == "zone":
         z = (SpeechResult or "").strip()
         if not z:
-            return _repeat("Puoi ripetere la zona di Milano?", "zone")
+            return await _repeat(PROMPTS["zone_retry"], "zone")
         s["data"]["zone"] = z
-        return _advance_and_say("timing", "Serve subito, entro ventiquattro ore, oppure nei prossimi giorni?")
+        return await _advance_and_say("timing", PROMPTS["ask_timing"])
 
     # 3) Tempistica
     if s["step"] == "timing":
@@ -342,15 +427,15 @@ async def voice_handle(
             s["data"]["timing"] = "entro 24h"
         else:
             s["data"]["timing"] = "entro 7 giorni"
-        return _advance_and_say("phone", "Perfetto. Mi lasci un numero di telefono per l’invio della stima e la chiamata di conferma?")
+        return await _advance_and_say("phone", PROMPTS["ask_phone"])
 
     # 4) Telefono
     if s["step"] == "phone":
         phone = clean_phone(SpeechResult or "")
         if not phone or len(re.sub(r"\D", "", phone)) < 9:
-            return _repeat("Il numero non sembra valido. Potresti ripeterlo lentamente, per favore?", "phone")
+            return await _repeat(PROMPTS["phone_retry"], "phone")
         s["data"]["phone"] = phone
-        return _advance_and_say("consent", "Confermi che possiamo far contattare il tuo numero da un’agenzia autorizzata della tua zona, solo per confermare il preventivo?")
+        return await _advance_and_say("consent", PROMPTS["ask_consent"])
 
     # 5) Consenso e chiusura
     if s["step"] == "consent":
@@ -360,9 +445,9 @@ async def voice_handle(
         resp = VoiceResponse()
 
         if not consent:
-            speak_in_response(resp, "Capito. Non procederò con il contatto. Se cambi idea, puoi richiamarci quando vuoi. Un caro saluto.")
+            speak_in_response(resp, PROMPTS["bye_no_consent"])
             resp.hangup()
-            sessions.pop(CallSid, None)
+            await finish_session(CallSid, s, "no_consent")
             return PlainTextResponse(str(resp), media_type="text/xml")
 
         # === Calcolo stripe_price_id
@@ -387,23 +472,61 @@ async def voice_handle(
             "sold_at": ""
         }
 
+        # === Accoda il salvataggio (journal su disco, store in background)
         try:
-            save_lead_to_gsheet(lead)
-        except Exception:
-            try:
-                save_lead_to_csv(lead)
-            except Exception as e:
-                print("ERRORE SALVATAGGIO CSV:", e)
-
-        speak_in_response(resp, "Grazie. Riceverai a breve una stima indicativa e la chiamata di conferma. Siamo a disposizione ventiquattro ore su ventiquattro.")
+            await asyncio.to_thread(lead_queue.put, lead)
+        except Exception as e:
+            print("ERRORE JOURNAL LEAD:", e, lead)
+
+        speak_in_response(resp, PROMPTS["bye_lead_saved"])
         resp.hangup()
-        sessions.pop(CallSid, None)
+        await finish_session(CallSid, s, "lead_saved")
         return PlainTextResponse(str(resp), media_type="text/xml")
 
     # Fallback
     resp = VoiceResponse()
-    speak_in_response(resp, "Grazie per la chiamata. Un saluto.")
+    speak_in_response(resp, PROMPTS["bye_fallback"])
     resp.hangup()
-    sessions.pop(CallSid, None)
+    await finish_session(CallSid, s, "fallback")
     return PlainTextResponse(str(resp), media_type="text/xml")
 
+@app.post("/voice/status")
+async def voice_status(
+    CallSid: str = Form(...),
+    CallStatus: str = Form(default=""),
+    CallDuration: str = Form(default=""),
+):
+    """StatusCallback Twilio (da impostare sul numero, evento 'completed'):
+    libera subito la sessione e registra durata, ultimo step ed esito."""
+    if CallStatus not in TERMINAL_CALL_STATUSES:
+        return Response(status_code=204)
+
+    s = await session_store.get(CallSid)
+    await session_store.delete(CallSid)
+    prompts.forget(CallSid)
+
+    if s and s.get("outcome"):
+        outcome = s["outcome"]
+    elif CallStatus != "completed":
+        outcome = CallStatus  # busy / no-answer / failed / canceled
+    elif s:
+        outcome = "abandoned"  # riattaccato o silenzio prima della fine del flusso
+    else:
+        outcome = "unknown"  # sessione già scaduta
+
+    if CallDuration.isdigit():
+        duration_s = int(CallDuration)
+    elif s and s.get("started_at"):
+        duration_s = round(time.time() - s["started_at"])
+    else:
+        duration_s = None
+
+    call_outcomes.record(CallSid, CallStatus, duration_s, s["step"] if s else None, outcome)
+    return Response(status_code=204)
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "warmup":
+        # pre-rendering dei prompt senza avviare il server
+        asyncio.run(warm_up_cli())
@@ -0,0 +1,50 @@
+import os
+import json
+import threading
+from pathlib import Path
+from datetime import datetime
+from collections import Counter
+
+# =========================
+# Esiti delle chiamate (una riga JSON per chiamata, dati del funnel)
+# =========================
+CALL_OUTCOMES_FILE = Path(os.getenv("CALL_OUTCOMES_FILE", "data/call_outcomes.jsonl"))
+
+# Stati Twilio con cui la chiamata è finita
+TERMINAL_CALL_STATUSES = {"completed", "busy", "no-answer", "failed", "canceled"}
+
+
+class CallOutcomeLog:
+    """Append-only su file JSONL + contatori in RAM per /health."""
+
+    def __init__(self, path: Path = CALL_OUTCOMES_FILE):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.outcomes = Counter()
+        self.last_steps = Counter()
+
+    def record(self, call_sid: str, status: str, duration_s, last_step, outcome: str):
+        # niente dati personali (telefono, zona): solo quello che serve al funnel
+        entry = {
+            "ts": datetime.utcnow().isoformat() + "Z",
+            "call_sid": call_sid,
+            "status": status,
+            "duration_s": duration_s,
+            "last_step": last_step,
+            "outcome": outcome,
+        }
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(line)
+            self.outcomes[outcome] += 1
+            if outcome == "abandoned":
+                self.last_steps[last_step] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "outcomes": dict(self.outcomes),
+                "abandoned_at_step": dict(self.last_steps),
+            }
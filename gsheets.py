@@ -0,0 +1,176 @@
+import os
+import time
+import threading
+from datetime import datetime, timezone
+
+import gspread
+from gspread.utils import rowcol_to_a1
+from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession, Request
+from requests.adapters import HTTPAdapter
+
+# =========================
+# Google Sheets: client condiviso nel processo
+# =========================
+SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE", "service_account_Sheet.json")
+SHEETS_SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+# Il token viene rinnovato in background SHEETS_TOKEN_MARGIN secondi prima della scadenza
+SHEETS_TOKEN_MARGIN = float(os.getenv("SHEETS_TOKEN_MARGIN", "300"))
+SHEETS_POOL_SIZE = int(os.getenv("SHEETS_POOL_SIZE", "10"))
+
+_client = None
+_creds = None
+_client_lock = threading.Lock()
+_refresher = None
+token_refreshes = 0
+
+
+def _refresh_token():
+    global token_refreshes
+    with _client_lock:
+        _creds.refresh(Request(_client.http_client.session))
+        token_refreshes += 1
+
+
+def _refresh_loop():
+    """Rinnova il token prima che scada: nessuna richiesta aspetta lo scambio OAuth."""
+    while True:
+        expiry = _creds.expiry.replace(tzinfo=timezone.utc) if _creds.expiry else None
+        wait = 0 if expiry is None else (expiry - datetime.now(timezone.utc)).total_seconds() - SHEETS_TOKEN_MARGIN
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            _refresh_token()
+        except Exception as e:
+            print(f"[Sheets] Rinnovo token fallito, riprovo tra 30s: {e}")
+            time.sleep(30)
+
+
+def get_client() -> gspread.Client:
+    """Client gspread unico per il processo (thread-safe): credenziali lette una volta,
+    una sola sessione HTTP con pool di connessioni, token rinnovato in anticipo."""
+    global _client, _creds, _refresher
+    with _client_lock:
+        if _client is None:
+            _creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SHEETS_SCOPES)
+            session = AuthorizedSession(_creds)
+            session.mount("https://", HTTPAdapter(pool_connections=SHEETS_POOL_SIZE, pool_maxsize=SHEETS_POOL_SIZE))
+            _client = gspread.Client(auth=_creds, session=session)
+            _creds.refresh(Request(session))  # primo token subito, poi ci pensa il thread
+        if _refresher is None:
+            _refresher = threading.Thread(target=_refresh_loop, name="sheets-token", daemon=True)
+            _refresher.start()
+        return _client
+
+
+def client_stats() -> dict:
+    expiry = _creds.expiry.isoformat() if _creds is not None and _creds.expiry else None
+    return {"ready": _client is not None, "token_expiry": expiry, "token_refreshes": token_refreshes}
+
+
+# =========================
+# Google Sheets: handle del foglio riusato tra le scritture
+# =========================
+# Errori dopo cui conviene riaprire il foglio (token scaduto, tab rinominata/cancellata)
+REOPEN_STATUS = {400, 401, 404}
+
+
+class WorksheetHandle:
+    """Apre spreadsheet + worksheet una volta sola e controlla l'header solo all'apertura.
+    Su auth scaduta o WorksheetNotFound l'handle viene riaperto e la scrittura ritentata una volta.
+
+    Anche la mappa header -> colonna è letta una volta per apertura: update_records()
+    aggiorna molte righe con un solo batch_update, senza find() per ogni cella.
+    """
+
+    def __init__(self, client, sheet_id: str, sheet_name: str, header: list):
+        self.client = client
+        self.sheet_id = sheet_id
+        self.sheet_name = sheet_name
+        self.header = list(header)
+        self._ws = None
+        self._columns = None
+        self._lock = threading.Lock()
+        self.opens = 0
+        self.batch_updates = 0
+        self.rows_updated = 0
+
+    def worksheet(self):
+        with self._lock:
+            if self._ws is None:
+                self._ws = self._open()
+            return self._ws
+
+    def _open(self):
+        sh = self.client.open_by_key(self.sheet_id)
+        try:
+            ws = sh.worksheet(self.sheet_name)
+        except gspread.WorksheetNotFound:
+            ws = sh.add_worksheet(title=self.sheet_name, rows="100", cols=str(len(self.header)))
+        # header controllato solo all'apertura, non ad ogni lead
+        if ws.row_count == 0 or ws.acell("A1").value is None:
+            ws.append_row(self.header, value_input_option="USER_ENTERED")
+        self.opens += 1
+        return ws
+
+    def invalidate(self):
+        with self._lock:
+            self._ws = None
+            self._columns = None
+
+    def header_map(self, ws=None) -> dict:
+        """Nome colonna -> indice (da 1), letto dalla prima riga una volta per apertura."""
+        ws = ws or self.worksheet()
+        with self._lock:
+            if self._columns is None:
+                self._columns = {name: i for i, name in enumerate(ws.row_values(1), start=1) if name}
+            return self._columns
+
+    def _call(self, fn):
+        try:
+            return fn(self.worksheet())
+        except gspread.WorksheetNotFound:
+            pass
+        except gspread.exceptions.APIError as e:
+            if getattr(e.response, "status_code", None) not in REOPEN_STATUS:
+                raise
+        print(f"[Sheets] Riapro il foglio '{self.sheet_name}'")
+        self.invalidate()
+        return fn(self.worksheet())
+
+    def update_records(self, records: dict):
+        """records: numero di riga -> {nome colonna: valore}. Una sola chiamata API per tutte le righe;
+        le chiavi che non sono colonne del foglio vengono ignorate."""
+        if not records:
+            return None
+
+        def _update(ws):
+            columns = self.header_map(ws)
+            width = max(columns.values())
+            last_row = max(records)
+            if last_row > ws.row_count:
+                ws.add_rows(last_row - ws.row_count)
+            data = []
+            for row_number, record in sorted(records.items()):
+                row = [""] * width
+                for name, col in columns.items():
+                    value = record.get(name, "")
+                    row[col - 1] = "" if value is None else value
+                data.append({
+                    "range": f"{rowcol_to_a1(row_number, 1)}:{rowcol_to_a1(row_number, width)}",
+                    "values": [row],
+                })
+            result = ws.batch_update(data, value_input_option="USER_ENTERED")
+            self.batch_updates += 1
+            self.rows_updated += len(data)
+            return result
+        return self._call(_update)
+
+    def stats(self) -> dict:
+        return {
+            "sheet_name": self.sheet_name,
+            "open": self._ws is not None,
+            "opens": self.opens,
+            "batch_updates": self.batch_updates,
+            "rows_updated": self.rows_updated,
+        }
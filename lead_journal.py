@@ -0,0 +1,212 @@
+import os
+import sys
+import csv
+import json
+import zlib
+import hashlib
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+try:
+    import fcntl  # lock tra processi (Linux); su Windows basta il lock tra thread
+except ImportError:
+    fcntl = None
+
+from lead_store import LeadStore
+
+# =========================
+# Journal delle lead (append-only, checksum, fsync di gruppo)
+# =========================
+LEAD_JOURNAL_FILE = Path(os.getenv("LEAD_JOURNAL_FILE", "data/lead_journal.log"))
+
+
+class JournalError(Exception):
+    pass
+
+
+class _Batch:
+    def __init__(self):
+        self.lines = []
+        self.done = False
+        self.error = None
+
+
+class LeadJournal:
+    """Righe "crc32 json": una riga troncata o corrotta viene scartata in lettura.
+
+    append() ritorna solo quando i record sono su disco. Le scritture concorrenti dei
+    thread vengono raggruppate: un solo write + fsync per tutti quelli che aspettano
+    (group commit). Tra processi (più worker uvicorn) si usa flock su un file .lock
+    a parte, che non cambia quando il journal viene compattato.
+
+    Record: {"op": "put", "id", "lead"} e {"op": "done", "id"}; l'id è il lead_uid.
+    """
+
+    def __init__(self, path: Path = LEAD_JOURNAL_FILE):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self._cond = threading.Condition()
+        self._io_lock = threading.Lock()
+        self._open_batch = _Batch()
+        self._flushing = False
+        self.records_written = 0
+        self.fsyncs = 0
+        self.corrupt = 0
+
+    # ---------- formato ----------
+    @staticmethod
+    def encode(record: dict) -> str:
+        payload = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        return f"{zlib.crc32(payload.encode('utf-8')):08x} {payload}\n"
+
+    @staticmethod
+    def decode(line: str):
+        crc, _, payload = line.rstrip("\n").partition(" ")
+        if not payload or f"{zlib.crc32(payload.encode('utf-8')):08x}" != crc:
+            return None
+        try:
+            return json.loads(payload)
+        except json.JSONDecodeError:
+            return None
+
+    # ---------- lock ----------
+    @contextmanager
+    def _locked(self):
+        with self._io_lock, open(self.lock_path, "a") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    # ---------- scrittura ----------
+    def _write(self, lines: list):
+        data = "".join(lines)
+        with self._locked():
+            with self.path.open("ab+") as f:
+                # ultima riga troncata (crash a metà scrittura): la si chiude, così il
+                # primo record nuovo non finisce attaccato a lei e scartato come corrotto
+                if f.seek(0, os.SEEK_END):
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        data = "\n" + data
+                f.write(data.encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+        self.fsyncs += 1
+        self.records_written += len(lines)
+
+    def append(self, *records: dict):
+        lines = [self.encode(r) for r in records]
+        with self._cond:
+            batch = self._open_batch
+            batch.lines.extend(lines)
+            while not batch.done:
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+                # nessuno sta scrivendo: questo thread scrive il batch aperto (che contiene anche il suo)
+                self._flushing = True
+                flush, self._open_batch = self._open_batch, _Batch()
+                self._cond.release()
+                try:
+                    self._write(flush.lines)
+                except Exception as e:
+                    flush.error = e
+                finally:
+                    self._cond.acquire()
+                    flush.done = True
+                    self._flushing = False
+                    self._cond.notify_all()
+        if batch.error:
+            raise JournalError(f"Scrittura journal fallita: {batch.error}")
+
+    # ---------- lettura ----------
+    def records(self):
+        """Record validi del journal; self.corrupt = righe scartate nell'ultima lettura completa."""
+        if not self.path.exists():
+            return
+        corrupt = 0
+        with self.path.open("r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                rec = self.decode(line)
+                if rec is None:
+                    corrupt += 1
+                    continue
+                yield rec
+        self.corrupt = corrupt
+
+    def pending(self) -> dict:
+        """lead_uid -> lead delle put senza done, in ordine di arrivo."""
+        pending = {}
+        for rec in self.records():
+            if rec.get("op") == "put":
+                pending[rec["id"]] = rec["lead"]
+            elif rec.get("op") == "done":
+                pending.pop(rec.get("id"), None)
+        return pending
+
+    def compact(self):
+        """Riscrive il journal con le sole put ancora aperte (anche quelle di altri processi)."""
+        with self._locked():
+            pending = self.pending()
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with tmp.open("w", encoding="utf-8") as f:
+                f.write("".join(self.encode({"op": "put", "id": uid, "lead": lead})
+                                for uid, lead in pending.items()))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+
+    def stats(self) -> dict:
+        return {
+            "records": self.records_written,
+            "fsyncs": self.fsyncs,
+            "records_per_fsync": round(self.records_written / self.fsyncs, 2) if self.fsyncs else 0.0,
+            "corrupt": self.corrupt,
+        }
+
+
+# ---------- Replay ----------
+def csv_uid(row: dict) -> str:
+    """lead_uid stabile per le righe del vecchio CSV di backup (stessa riga = stesso uid)."""
+    raw = f"{row.get('timestamp', '')}|{row.get('phone', '')}|{row.get('source', '')}"
+    return "csv-" + hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def replay(csv_path: str = None):
+    """Carica nello store le lead rimaste nel journal (ed eventualmente un vecchio CSV).
+    Idempotente: lo store ignora i lead_uid già presenti."""
+    store = LeadStore()
+    journal = LeadJournal()
+    before = store.stats()["leads"]
+
+    pending = journal.pending()
+    if pending:
+        store.insert_many([{**lead, "lead_uid": uid} for uid, lead in pending.items()])
+        journal.append(*({"op": "done", "id": uid} for uid in pending))
+        journal.compact()
+
+    from_csv = 0
+    if csv_path:
+        with open(csv_path, newline="", encoding="utf-8-sig") as f:
+            rows = [{**row, "lead_uid": csv_uid(row)} for row in csv.DictReader(f)]
+        store.insert_many(rows)
+        from_csv = len(rows)
+
+    added = store.stats()["leads"] - before
+    print(f"🔁 Replay: {len(pending)} lead dal journal, {from_csv} dal CSV, {added} nuove nello store "
+          f"({len(pending) + from_csv - added} già presenti). Righe corrotte scartate: {journal.corrupt}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        replay(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        print("Uso: python lead_journal.py replay [data/leads.csv]")
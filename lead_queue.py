@@ -0,0 +1,190 @@
+import os
+import time
+import uuid
+import threading
+from itertools import islice
+from collections import deque
+
+from metrics import LatencyStats
+from lead_journal import LeadJournal
+
+# =========================
+# Coda lead persistente (journal locale + worker in background)
+# =========================
+# Tentativi di salvataggio con backoff esponenziale; poi la lead resta nel journal
+# e si recupera con "python lead_journal.py replay"
+LEAD_QUEUE_MAX_ATTEMPTS = int(os.getenv("LEAD_QUEUE_MAX_ATTEMPTS", "8"))
+LEAD_QUEUE_BACKOFF = float(os.getenv("LEAD_QUEUE_BACKOFF", "1"))
+LEAD_QUEUE_BACKOFF_MAX = float(os.getenv("LEAD_QUEUE_BACKOFF_MAX", "60"))
+# Quota superata (429, es. Google Sheets): la finestra è al minuto, inutile riprovare prima
+LEAD_QUEUE_QUOTA_BACKOFF = float(os.getenv("LEAD_QUEUE_QUOTA_BACKOFF", "15"))
+# Micro-batching: si scrive dopo LEAD_BATCH_WINDOW secondi dalla prima lead o a LEAD_BATCH_SIZE lead
+LEAD_BATCH_WINDOW = float(os.getenv("LEAD_BATCH_WINDOW", "0.5"))
+LEAD_BATCH_SIZE = int(os.getenv("LEAD_BATCH_SIZE", "50"))
+
+
+class LeadQueue:
+    """put() scrive la lead sul journal (LeadJournal, fsync di gruppo) e ritorna; un thread
+    raccoglie le lead in batch e le salva con sink(leads) (una sola transazione sullo store),
+    con retry. Dopo LEAD_QUEUE_MAX_ATTEMPTS il batch resta aperto nel journal per il replay.
+
+    L'id nel journal è anche il lead_uid della lead, così un batch ripetuto (dopo un crash,
+    da un altro worker o dal replay) non crea doppioni nello store. All'avvio le put senza
+    done vengono rimesse in coda: una lead accettata non si perde.
+    """
+
+    def __init__(self, sink, journal: LeadJournal = None,
+                 max_attempts: int = LEAD_QUEUE_MAX_ATTEMPTS,
+                 batch_window: float = LEAD_BATCH_WINDOW, batch_size: int = LEAD_BATCH_SIZE):
+        self.sink = sink
+        self.journal = journal or LeadJournal()
+        self.max_attempts = max_attempts
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self._pending = deque()  # (id, lead, accodata_alle)
+        self._undone = []  # id salvati nello store il cui done non è ancora sul journal
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._thread = None
+        self._stop = False
+        self.written = 0
+        self.retries = 0
+        self.stranded = 0
+        self.last_error = None
+        self.quota_errors = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.latency = LatencyStats()
+        self._replay()
+
+    def _replay(self):
+        pending = self.journal.pending()
+        # recuperate dal journal: nessuna attesa della finestra di batching
+        self._pending.extend((lead_id, lead, 0.0) for lead_id, lead in pending.items())
+        self.journal.compact()
+        if pending:
+            print(f"[Lead queue] {len(pending)} lead da salvare recuperate dal journal")
+
+    # ---------- API ----------
+    def put(self, lead: dict) -> str:
+        lead_id = lead.get("lead_uid") or uuid.uuid4().hex
+        # enqueued_at: da qui lead_watcher misura la latenza fino all'email al buyer
+        lead = {**lead, "lead_uid": lead_id, "enqueued_at": lead.get("enqueued_at") or time.time()}
+        # fuori dal lock della coda: put concorrenti condividono lo stesso fsync
+        self.journal.append({"op": "put", "id": lead_id, "lead": lead})
+        with self._cond:
+            self._pending.append((lead_id, lead, time.monotonic()))
+            self._cond.notify()
+        return lead_id
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="lead-queue", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+
+    # ---------- worker ----------
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stop:
+                    self._cond.wait()
+                # aspetta altre lead fino alla fine della finestra o al batch pieno
+                deadline = self._pending[0][2] + self.batch_window if self._pending else 0
+                while not self._stop and len(self._pending) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._stop:
+                    return  # le lead rimaste sono nel journal
+                batch = list(islice(self._pending, self.batch_size))
+            try:
+                self._deliver(batch)
+            except Exception as e:
+                # il thread non deve morire: il batch resta in coda e si riprova
+                self.last_error = str(e)
+                print("[Lead queue] errore inatteso, riprovo:", e)
+                with self._cond:
+                    if self._cond.wait_for(lambda: self._stop, timeout=LEAD_QUEUE_BACKOFF):
+                        return
+
+    def _deliver(self, batch: list):
+        leads = [lead for _, lead, _ in batch]
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                self.sink(leads)
+                self.latency.add(time.perf_counter() - started)
+                self.written += len(leads)
+                self.batches += 1
+                self.max_batch = max(self.max_batch, len(leads))
+                break
+            except Exception as e:
+                attempt += 1
+                self.last_error = str(e)
+                print(f"[Lead queue] batch di {len(leads)}: tentativo {attempt}/{self.max_attempts} fallito:", e)
+                delay = min(LEAD_QUEUE_BACKOFF * 2 ** (attempt - 1), LEAD_QUEUE_BACKOFF_MAX)
+                if getattr(getattr(e, "response", None), "status_code", None) == 429:
+                    self.quota_errors += 1
+                    delay = max(delay, LEAD_QUEUE_QUOTA_BACKOFF)
+                if attempt >= self.max_attempts:
+                    # niente done: le lead restano nel journal (prossimo avvio o replay manuale)
+                    self.stranded += len(leads)
+                    print(f"[Lead queue] {len(leads)} lead lasciate nel journal: python lead_journal.py replay")
+                    with self._cond:
+                        for _ in batch:
+                            self._pending.popleft()
+                    return
+                self.retries += 1
+                with self._cond:
+                    if self._cond.wait_for(lambda: self._stop, timeout=delay):
+                        return
+
+        with self._cond:
+            for _ in batch:
+                self._pending.popleft()
+            drained = not self._pending
+        # le lead sono già nello store: se il done non si scrive (es. disco pieno) si riprova
+        # col batch successivo, e intanto un replay le salterebbe comunque (lead_uid)
+        done = self._undone + [lead_id for lead_id, _, _ in batch]
+        try:
+            self.journal.append(*({"op": "done", "id": lead_id} for lead_id in done))
+        except Exception as e:
+            self._undone = done
+            self.last_error = str(e)
+            print(f"[Lead queue] done di {len(done)} lead non scritti sul journal, riprovo più tardi:", e)
+            return
+        self._undone = []
+        if drained:
+            try:
+                self.journal.compact()
+            except Exception as e:
+                self.last_error = str(e)
+                print("[Lead queue] compattazione journal fallita:", e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "written": self.written,
+            "retries": self.retries,
+            "stranded": self.stranded,
+            "quota_errors": self.quota_errors,
+            "last_error": self.last_error,
+            "batches": self.batches,
+            "avg_batch": round(self.written / self.batches, 2) if self.batches else 0.0,
+            "max_batch": self.max_batch,
+            "flush_latency": self.latency.stats(),
+            "journal": self.journal.stats(),
+        }
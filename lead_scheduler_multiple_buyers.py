@@ -1,46 +1,38 @@
-import os, time, json, smtplib
+import os, sys, time, json, heapq, smtplib
+from pathlib import Path
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
-import gspread
-from google.oauth2.service_account import Credentials
 from dotenv import load_dotenv
 import stripe
 
+from lead_store import LeadStore
+
 load_dotenv()
 
 # === ENV ===
 STRIPE_API_KEY   = os.getenv("STRIPE_SECRET_KEY")
 EMAIL_FROM       = os.getenv("EMAIL_FROM")
 EMAIL_PASS       = os.getenv("EMAIL_APP_PASSWORD")
-GOOGLE_SHEETS_ID = os.getenv("GOOGLE_SHEETS_ID")
-SHEET_NAME       = os.getenv("SHEET_NAME", "Sheet1")
 
 SMTP_HOST = "smtp.gmail.com"
 SMTP_PORT_SSL = 465
 
-stripe.api_key = STRIPE_API_KEY
-
+# Dopo quanto l'ultimo buyer perde la lead
+REASSIGN_AFTER = timedelta(minutes=30)
+# Heap delle scadenze salvato tra un riavvio e l'altro
+SCHEDULER_STATE_FILE = Path(os.getenv("SCHEDULER_STATE_FILE", "data/scheduler_heap.json"))
+# Dopo un errore Stripe/email la riassegnazione si ritenta tra SCHEDULER_RETRY secondi
+SCHEDULER_RETRY = float(os.getenv("SCHEDULER_RETRY", "30"))
+# Margine sul watermark del feed delle modifiche (commit di processi diversi fuori ordine)
+SCHEDULER_WATERMARK_OVERLAP = 5.0
 
-# ---------- Helpers Google Sheets ----------
-def ws_readonly():
-    scopes = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
-    creds  = Credentials.from_service_account_file("service_account_Sheet.json", scopes=scopes)
-    gc     = gspread.authorize(creds)
-    return gc.open_by_key(GOOGLE_SHEETS_ID).worksheet(SHEET_NAME)
-
-def ws_readwrite():
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds  = Credentials.from_service_account_file("service_account_Sheet.json", scopes=scopes)
-    gc     = gspread.authorize(creds)
-    return gc.open_by_key(GOOGLE_SHEETS_ID).worksheet(SHEET_NAME)
+stripe.api_key = STRIPE_API_KEY
 
-def update_cell(row_index: int, header_name: str, value: str):
-    ws = ws_readwrite()
-    col = ws.find(header_name).col
-    ws.update_cell(row_index, col, value)
+# Lead store locale (data/leads.db); il foglio viene aggiornato da sheet_sync.py
+store = LeadStore()
 
 
 # ---------- Email ----------
@@ -58,73 +50,155 @@ def send_email(to_email: str, subject: str, body_txt: str):
     print("📧 Email inviata a:", to_email)
 
 
-# ---------- Core ----------
-def check_and_reassign():
-    ws = ws_readonly()
-    rows = ws.get_all_records()
+# ---------- Scadenze (min-heap) ----------
+def deadline_of(lead: dict):
+    """Istante (epoch) in cui la lead va riassegnata; None se sent_at manca o non è valido."""
+    sent_at_str = (lead.get("sent_at") or "").strip()
+    if not sent_at_str:
+        return None
+    try:
+        return datetime.fromisoformat(sent_at_str).timestamp() + REASSIGN_AFTER.total_seconds()
+    except Exception:
+        return None
 
-    with open("buyers.json", "r", encoding="utf-8") as f:
-        buyers = json.load(f)
 
-    for row_index, lead in enumerate(rows, start=2):  # 2 perché riga 1 = header
-        status = (lead.get("status") or "").strip().lower()
-        sent_at_str = lead.get("sent_at", "").strip()
+class DeadlineHeap:
+    """Min-heap di (quando, lead_id, scadenza) delle lead "inviato_*", salvato su file tra un riavvio
+    e l'altro. "quando" è la scadenza stessa, o l'ora del ritentativo dopo un errore.
 
-        if not status.startswith("inviato_"):
-            continue
+    Si aggiorna leggendo dallo store solo le lead cambiate dopo l'ultimo watermark
+    (invii del watcher e dello scheduler, vendite del webhook). Una vendita non toglie
+    la voce dall'heap: alla scadenza la lead viene riletta e, se nel frattempo è stata
+    venduta o riassegnata, la voce è semplicemente scartata.
+    """
 
-        if not sent_at_str:
-            print(f"⚠️ Riga {row_index}: status={status} ma manca sent_at, salto.")
-            continue
+    def __init__(self, path: Path = SCHEDULER_STATE_FILE):
+        self.path = Path(path)
+        self.heap = []
+        self._keys = set()  # (lead_id, scadenza) già nell'heap: il margine sul watermark rilegge lead già viste
+        self.watermark = 0.0  # updated_at più recente già letto dallo store
 
+    def load(self) -> bool:
         try:
-            sent_at = datetime.fromisoformat(sent_at_str)
-        except Exception:
-            print(f"⚠️ Riga {row_index}: sent_at non valido ({sent_at_str}), salto.")
-            continue
-
-        # aspetta 30 minuti dall'ultimo invio
-        if datetime.now(ZoneInfo("Europe/Rome")) - sent_at < timedelta(minutes=30):
-            continue
-
-        # trova quale buyer ha ricevuto l'ultima email
-        last_buyer_name = status.replace("inviato_", "")
-        last_index = next((i for i, b in enumerate(buyers) if b["name"].lower() == last_buyer_name.lower()), None)
-
-        if last_index is None:
-            print(f"⚠️ Riga {row_index}: buyer {last_buyer_name} non trovato in buyers.json")
-            continue
-
-        next_index = last_index + 1
-        if next_index >= len(buyers):
-            # non ci sono più buyer -> invenduto
-            update_cell(row_index, "status", "invenduto")
-            print(f"🚫 Lead riga {row_index} segnato come invenduto")
-            continue
-
-        next_buyer = buyers[next_index]
+            with self.path.open("r", encoding="utf-8") as f:
+                state = json.load(f)
+            self.heap = [(float(at), int(i), float(d)) for at, i, d in state["deadlines"]]
+            self.watermark = float(state["watermark"])
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return False
+        heapq.heapify(self.heap)
+        self._keys = {(i, d) for _, i, d in self.heap}
+        return True
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump({"watermark": self.watermark, "deadlines": self.heap}, f)
+        os.replace(tmp, self.path)
+
+    def push(self, lead: dict):
+        status = (lead.get("status") or "").strip().lower()
+        if not status.startswith("inviato_"):
+            return
+        deadline = deadline_of(lead)
+        if deadline is None:
+            print(f"⚠️ Lead {lead['lead_id']}: status={status} ma sent_at mancante o non valido, salto.")
+            return
+        if (lead["lead_id"], deadline) in self._keys:
+            return
+        self._keys.add((lead["lead_id"], deadline))
+        heapq.heappush(self.heap, (deadline, lead["lead_id"], deadline))
+
+    def retry(self, lead_id: int, deadline: float):
+        self._keys.add((lead_id, deadline))
+        heapq.heappush(self.heap, (time.time() + SCHEDULER_RETRY, lead_id, deadline))
+
+    def rebuild(self):
+        self.heap, self._keys = [], set()
+        self.watermark = time.time()
+        for lead in store.by_status_prefix("inviato_"):
+            self.push(lead)
+        self.save()
+
+    def refresh(self):
+        """Aggiunge le scadenze delle lead cambiate dopo il watermark (query indicizzata, niente API)."""
+        # piccolo margine: una transazione di un altro processo può finire dopo una più recente
+        since, after_id = self.watermark - SCHEDULER_WATERMARK_OVERLAP, 0
+        watermark = self.watermark
+        while True:
+            leads = store.changed_since(since, after_id)
+            for lead in leads:
+                self.push(lead)
+                watermark = max(watermark, lead["updated_at"])
+            if len(leads) < 1000:
+                break
+            since, after_id = leads[-1]["updated_at"], leads[-1]["lead_id"]
+        if watermark != self.watermark:
+            self.watermark = watermark
+            self.save()
+
+    def next_at(self):
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now: float) -> list:
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            self._keys.discard((entry[1], entry[2]))
+            due.append(entry)
+        return due
+
+
+deadlines = DeadlineHeap()
 
-        # crea checkout session per il nuovo buyer
-        try:
-            session = stripe.checkout.Session.create(
-                mode="payment",
-                line_items=[{"price": lead["stripe_price_id"], "quantity": 1}],
-                success_url="https://example.com/success",
-                cancel_url="https://example.com/cancel",
-                client_reference_id=str(row_index - 1),
-                metadata={"lead_id": str(row_index - 1), "buyer_index": str(next_index)},
-                expires_at=int(time.time()) + 30 * 60
-            )
-            checkout_url = session.url
-        except Exception as e:
-            print(f"❌ Stripe error riga {row_index}: {e}")
-            continue
 
-        # prepara email
-        subject = f"Nuovo lead! – {lead.get('service','')}"
-        phone = str(lead.get("phone", ""))
-        masked_phone = phone[:1] + " *** " + phone[-1:] if len(phone) > 5 else "******"
-        body_txt = f"""Hai ricevuto un nuovo lead:
+# ---------- Core ----------
+def reassign_lead(lead: dict, buyers: list) -> bool:
+    """Passa la lead al buyer successivo (o la segna invenduto). False = da ritentare."""
+    lead_id = lead["lead_id"]  # = riga del foglio - 1
+    status = (lead.get("status") or "").strip().lower()
+
+    # trova quale buyer ha ricevuto l'ultima email
+    last_buyer_name = status.replace("inviato_", "")
+    last_index = next((i for i, b in enumerate(buyers) if b["name"].lower() == last_buyer_name.lower()), None)
+
+    if last_index is None:
+        print(f"⚠️ Lead {lead_id}: buyer {last_buyer_name} non trovato in buyers.json")
+        return True
+
+    next_index = last_index + 1
+    if next_index >= len(buyers):
+        # non ci sono più buyer -> invenduto (se nel frattempo non è stata pagata)
+        if store.update_if(lead_id, lead["status"], status="invenduto"):
+            print(f"🚫 Lead {lead_id} segnato come invenduto")
+        else:
+            print(f"ℹ️ Lead {lead_id} cambiata nel frattempo (venduta?), non la segno invenduto")
+        return True
+
+    next_buyer = buyers[next_index]
+
+    # crea checkout session per il nuovo buyer
+    try:
+        session = stripe.checkout.Session.create(
+            mode="payment",
+            line_items=[{"price": lead["stripe_price_id"], "quantity": 1}],
+            success_url="https://example.com/success",
+            cancel_url="https://example.com/cancel",
+            client_reference_id=str(lead_id),
+            metadata={"lead_id": str(lead_id), "buyer_index": str(next_index)},
+            expires_at=int(time.time()) + 30 * 60
+        )
+        checkout_url = session.url
+    except Exception as e:
+        print(f"❌ Stripe error lead {lead_id}: {e}")
+        return False
+
+    # prepara email
+    subject = f"Nuovo lead! – {lead.get('service','')}"
+    phone = str(lead.get("phone", ""))
+    masked_phone = phone[:1] + " *** " + phone[-1:] if len(phone) > 5 else "******"
+    body_txt = f"""Hai ricevuto un nuovo lead:
 
 Servizio: {lead.get('service','')}
 Zona: {lead.get('zone','')}
@@ -136,23 +210,84 @@ Per ricevere il numero completo, procedi al pagamento (entro 30 minuti) cliccand
 {checkout_url}
 """
 
-        try:
-            send_email(next_buyer["email"], subject, body_txt)
-            print(f"✅ Email inviata a {next_buyer['name']} ({next_buyer['email']}) per riga {row_index}")
-        except Exception as e:
-            print(f"❌ Errore invio email riga {row_index}: {e}")
-            continue
+    # Stripe può aver impiegato secondi: se intanto il buyer precedente ha pagato, niente email
+    if store.is_sold(lead_id):
+        print(f"ℹ️ Lead {lead_id} venduta nel frattempo, non la riassegno")
+        return True
+
+    try:
+        send_email(next_buyer["email"], subject, body_txt)
+        print(f"✅ Email inviata a {next_buyer['name']} ({next_buyer['email']}) per lead {lead_id}")
+    except Exception as e:
+        print(f"❌ Errore invio email lead {lead_id}: {e}")
+        return False
+
+    # aggiorna la lead con il nome ufficiale preso da buyers.json, solo se nessuno l'ha
+    # toccata nel frattempo: una vendita arrivata durante l'invio non va sovrascritta
+    # (la nuova scadenza arriva nell'heap dal feed delle modifiche)
+    try:
+        updated = store.update_if(
+            lead_id,
+            lead["status"],
+            status=f"inviato_{next_buyer['name']}",
+            sent_at=datetime.now(ZoneInfo("Europe/Rome")).isoformat(timespec="seconds"),
+        )
+        if not updated:
+            print(f"ℹ️ Lead {lead_id} venduta durante l'invio: status lasciato com'è")
+    except Exception as e:
+        print(f"❌ Errore aggiornamento lead {lead_id}: {e}")
+    return True
 
-        # aggiorna lo sheet con il nome ufficiale preso da buyers.json
-        try:
-            update_cell(row_index, "status", f"inviato_{next_buyer['name']}")
-            update_cell(row_index, "sent_at", datetime.now(ZoneInfo("Europe/Rome")).isoformat(timespec="seconds"))
-        except Exception as e:
-            print(f"❌ Errore aggiornamento sheet riga {row_index}: {e}")
+
+def check_and_reassign():
+    """Riassegna le lead scadute; solo letture locali quando non scade niente."""
+    deadlines.refresh()
+    due = deadlines.pop_due(time.time())
+    if not due:
+        return
+
+    with open("buyers.json", "r", encoding="utf-8") as f:
+        buyers = json.load(f)
+
+    for _, lead_id, deadline in due:
+        lead = store.get(lead_id)
+        # venduta o già riassegnata: la scadenza non vale più
+        if not lead or not (lead.get("status") or "").strip().lower().startswith("inviato_"):
+            continue
+        current = deadline_of(lead)
+        if current is None or abs(current - deadline) > 1e-6:
+            continue
+        lateness = time.time() - deadline
+        if not reassign_lead(lead, buyers):
+            # errore Stripe/email: si riprova tra poco
+            deadlines.retry(lead_id, deadline)
+            continue
+        print(f"⏱️ Lead {lead_id} riassegnata con {lateness:.2f}s di ritardo sulla scadenza")
+    deadlines.save()
 
 
 if __name__ == "__main__":
     print("⏳ Avvio scheduler lead...")
+    if not store.is_imported():
+        # prima dell'import i lead_id locali coincidono con righe storiche del foglio
+        print("⛔ Lead del foglio non ancora importate: eseguire prima 'python sheet_sync.py import'.")
+        sys.exit(1)
+    if deadlines.load():
+        print(f"📂 {len(deadlines.heap)} scadenze caricate da {deadlines.path}")
+    else:
+        deadlines.rebuild()
+        print(f"🧮 Heap delle scadenze ricostruito dallo store: {len(deadlines.heap)} lead in attesa")
     while True:
-        check_and_reassign()
-        time.sleep(30)  # controlla ogni 30 secondi
+        try:
+            check_and_reassign()
+            # dorme fino alla prossima scadenza; al massimo REASSIGN_AFTER, così le lead
+            # inviate nel frattempo (che scadono dopo) entrano nell'heap prima della loro scadenza
+            next_at = deadlines.next_at()
+            sleep_for = REASSIGN_AFTER.total_seconds() if next_at is None else next_at - time.time()
+            time.sleep(min(max(sleep_for, 0), REASSIGN_AFTER.total_seconds()))
+        except KeyboardInterrupt:
+            print("👋 Uscita richiesta.")
+            break
+        except Exception as e:
+            print(f"❌ Errore inatteso nello scheduler: {e}")
+            time.sleep(SCHEDULER_RETRY)
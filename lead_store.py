@@ -0,0 +1,409 @@
+import os
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+# =========================
+# Lead store locale (SQLite): sistema di riferimento per tutte le lead
+# =========================
+# Il foglio Google è solo uno specchio per chi lo consulta (vedi sheet_sync.py).
+# lead_id = riga del foglio - 1, come prima: i checkout Stripe già inviati restano validi.
+LEADS_DB = Path(os.getenv("LEADS_DB", "data/leads.db"))
+# Cache read-through delle lead lette per id (es. webhook Stripe)
+LEAD_CACHE_SIZE = int(os.getenv("LEAD_CACHE_SIZE", "256"))
+LEAD_CACHE_TTL = float(os.getenv("LEAD_CACHE_TTL", "60"))
+
+# Colonne della lead nello store -> nome della colonna nel foglio
+FIELDS = {
+    "vertical": "vertical",
+    "city": "city",
+    "service": "service",
+    "zone": "zone",
+    "timing": "timing",
+    "phone": "phone",
+    "consent": "consent",
+    "source": "source",
+    "timestamp": "timestamp",
+    "stripe_price_id": "stripe_price_id",
+    "price": "€",
+    "status": "status",
+    "sent_at": "sent_at",
+    "sold_at": "sold_at",
+}
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS leads (
+    lead_id INTEGER PRIMARY KEY,
+    lead_uid TEXT UNIQUE,
+    {", ".join(f"{col} TEXT NOT NULL DEFAULT ''" for col in FIELDS)},
+    updated_at REAL NOT NULL,
+    synced_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_leads_status ON leads(status);
+CREATE INDEX IF NOT EXISTS idx_leads_sent_at ON leads(sent_at);
+CREATE INDEX IF NOT EXISTS idx_leads_updated_at ON leads(updated_at);
+CREATE INDEX IF NOT EXISTS idx_leads_unsynced ON leads(lead_id) WHERE synced_at IS NULL OR synced_at < updated_at;
+-- eventi "lead creata" per lead_watcher (scritti nella stessa transazione della lead)
+CREATE TABLE IF NOT EXISTS lead_events (
+    event_id INTEGER PRIMARY KEY,
+    lead_id INTEGER NOT NULL,
+    enqueued_at REAL NOT NULL
+);
+-- una sola vendita per lead: la riga la "prenota" l'evento Stripe che arriva per primo
+CREATE TABLE IF NOT EXISTS lead_sales (
+    lead_id INTEGER PRIMARY KEY,
+    event_id TEXT,
+    status TEXT NOT NULL,
+    sold_at TEXT NOT NULL,
+    emailed_at TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def normalize_status(status) -> str:
+    """Status come lo scrivono i processi: "Nuovo " -> "nuovo", "INVIATO_Mario" -> "inviato_Mario"
+    (le righe del foglio scritte a mano non sempre lo sono; il nome del buyer resta com'è)."""
+    head, sep, tail = str(status or "").strip().partition("_")
+    return head.lower() + sep + tail
+
+
+class LeadStore:
+    """Lead su SQLite in WAL: più processi (app, watcher, scheduler, webhook) leggono
+    e scrivono insieme. Le lead escono come dict con le chiavi del foglio ("€" compreso)
+    più lead_id e lead_uid.
+    """
+
+    def __init__(self, path: Path = LEADS_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=10000")
+        self._db.executescript(SCHEMA)
+        self._normalize_statuses()
+
+    def _normalize_statuses(self):
+        """Una tantum: status scritti a mano già importati prima di normalize_status().
+        updated_at nuovo: scheduler e sheet_sync rivedono le lead corrette."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                done = self._db.execute("SELECT 1 FROM meta WHERE key = 'status_normalized'").fetchone()
+                if not done:
+                    now = time.time()
+                    rows = self._db.execute("SELECT lead_id, status FROM leads").fetchall()
+                    self._db.executemany(
+                        "UPDATE leads SET status = ?, updated_at = ? WHERE lead_id = ?",
+                        [(normalize_status(r["status"]), now, r["lead_id"])
+                         for r in rows if normalize_status(r["status"]) != r["status"]],
+                    )
+                    self._db.execute("INSERT INTO meta (key, value) VALUES ('status_normalized', ?)", (str(now),))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _record(row) -> dict:
+        rec = {"lead_id": row["lead_id"], "lead_uid": row["lead_uid"]}
+        for col, sheet_name in FIELDS.items():
+            rec[sheet_name] = row[col]
+        rec["updated_at"] = row["updated_at"]
+        return rec
+
+    @staticmethod
+    def _values(lead: dict) -> list:
+        values = []
+        for col, sheet_name in FIELDS.items():
+            value = lead.get(sheet_name, lead.get(col, ""))
+            values.append("" if value is None else str(value))
+        return values
+
+    # ---------- scritture ----------
+    def insert_many(self, leads: list) -> list:
+        """Inserisce le lead (idempotente su lead_uid) e ritorna i lead_id assegnati.
+
+        Per ogni lead davvero nuova pubblica un evento in lead_events, con l'ora in cui
+        la lead è stata accettata (enqueued_at, messo da LeadQueue.put) se presente.
+        """
+        cols = ", ".join(FIELDS)
+        marks = ", ".join("?" for _ in FIELDS)
+        now = time.time()
+        ids = []
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for lead in leads:
+                    uid = lead.get("lead_uid") or None
+                    cur = self._db.execute(
+                        f"INSERT OR IGNORE INTO leads (lead_uid, {cols}, updated_at) VALUES (?, {marks}, ?)",
+                        [uid, *self._values(lead), now],
+                    )
+                    if cur.rowcount:
+                        ids.append(cur.lastrowid)
+                        self._db.execute(
+                            "INSERT INTO lead_events (lead_id, enqueued_at) VALUES (?, ?)",
+                            (cur.lastrowid, float(lead.get("enqueued_at") or now)),
+                        )
+                    else:  # già inserita (es. replay del journal)
+                        ids.append(self._db.execute(
+                            "SELECT lead_id FROM leads WHERE lead_uid = ?", (uid,)).fetchone()[0])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return ids
+
+    def update(self, lead_id: int, **fields):
+        """Aggiorna campi della lead (nomi dello store, es. price e non €); la marca da sincronizzare."""
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Campi lead sconosciuti: {', '.join(sorted(unknown))}")
+        assignments = ", ".join(f"{col} = ?" for col in fields)
+        with self._lock:
+            cur = self._db.execute(
+                f"UPDATE leads SET {assignments}, updated_at = ? WHERE lead_id = ?",
+                [*(str(v) for v in fields.values()), time.time(), lead_id],
+            )
+        if not cur.rowcount:
+            raise KeyError(f"Lead {lead_id} non trovata")
+
+    def update_if(self, lead_id: int, expected_status: str, **fields) -> bool:
+        """Come update(), ma solo se la lead ha ancora expected_status e non è stata venduta
+        nel frattempo (lead_sales). False = lead cambiata da qualcun altro, niente scritto."""
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Campi lead sconosciuti: {', '.join(sorted(unknown))}")
+        assignments = ", ".join(f"{col} = ?" for col in fields)
+        with self._lock:
+            cur = self._db.execute(
+                f"UPDATE leads SET {assignments}, updated_at = ? WHERE lead_id = ? AND status = ? "
+                "AND lead_id NOT IN (SELECT lead_id FROM lead_sales)",
+                [*(str(v) for v in fields.values()), time.time(), lead_id, expected_status],
+            )
+        return cur.rowcount > 0
+
+    # ---------- vendite ----------
+    def is_sold(self, lead_id: int) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM lead_sales WHERE lead_id = ?", (lead_id,)).fetchone() is not None
+
+    def claim_sale(self, lead_id: int, event_id: str, status: str, sold_at: str) -> dict:
+        """Prenota la vendita della lead per event_id e, se la prenotazione è sua, scrive
+        status/sold_at sulla lead nella stessa transazione.
+
+        Ritorna la riga di lead_sales: se event_id è diverso da quello passato la lead era
+        già stata venduta (event_id None = venduta prima che esistesse lead_sales).
+        Per lo stesso event_id è rientrante: un retry ritrova la sua prenotazione.
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                lead = self._db.execute("SELECT status, sold_at FROM leads WHERE lead_id = ?", (lead_id,)).fetchone()
+                if lead is None:
+                    raise KeyError(f"Lead {lead_id} non trovata")
+                sale = self._db.execute("SELECT * FROM lead_sales WHERE lead_id = ?", (lead_id,)).fetchone()
+                if sale is None:
+                    if lead["status"].startswith("venduto"):
+                        sale_row = (lead_id, None, lead["status"], lead["sold_at"])
+                    else:
+                        sale_row = (lead_id, event_id, status, sold_at)
+                        self._db.execute(
+                            "UPDATE leads SET status = ?, sold_at = ?, updated_at = ? WHERE lead_id = ?",
+                            (status, sold_at, time.time(), lead_id))
+                    self._db.execute(
+                        "INSERT INTO lead_sales (lead_id, event_id, status, sold_at) VALUES (?, ?, ?, ?)", sale_row)
+                    sale = self._db.execute("SELECT * FROM lead_sales WHERE lead_id = ?", (lead_id,)).fetchone()
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return dict(sale)
+
+    def mark_sale_emailed(self, lead_id: int, emailed_at: str):
+        with self._lock:
+            self._db.execute("UPDATE lead_sales SET emailed_at = ? WHERE lead_id = ?", (emailed_at, lead_id))
+
+    # ---------- letture ----------
+    def get(self, lead_id: int):
+        with self._lock:
+            row = self._db.execute("SELECT * FROM leads WHERE lead_id = ?", (lead_id,)).fetchone()
+        return self._record(row) if row else None
+
+    def by_status_after(self, status: str, after_id: int, limit: int = 500) -> list:
+        """Lead con lead_id > after_id e quello status: range sulla chiave primaria,
+        costa quanto le lead nuove e non quanto tutto lo storico."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM leads WHERE lead_id > ? AND status = ? ORDER BY lead_id LIMIT ?",
+                (after_id, status, limit)).fetchall()
+        return [self._record(r) for r in rows]
+
+    def by_status_prefix(self, prefix: str) -> list:
+        # GLOB con prefisso fisso usa l'indice su status (LIKE no, è case-insensitive)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM leads WHERE status GLOB ? ORDER BY lead_id", (prefix + "*",)).fetchall()
+        return [self._record(r) for r in rows]
+
+    def changed_since(self, updated_at: float, after_id: int = 0, limit: int = 1000) -> list:
+        """Lead modificate dopo (updated_at, after_id), in ordine di modifica: feed delle
+        modifiche per lo scheduler. Per la pagina successiva si passa l'ultima lead letta."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM leads WHERE updated_at >= ? AND (updated_at > ? OR lead_id > ?) "
+                "ORDER BY updated_at, lead_id LIMIT ?",
+                (updated_at, updated_at, after_id, limit)).fetchall()
+        return [self._record(r) for r in rows]
+
+    # ---------- eventi lead creata ----------
+    def events(self, limit: int = 100) -> list:
+        """Eventi non ancora consumati: [(event_id, lead_id, enqueued_at)]."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT event_id, lead_id, enqueued_at FROM lead_events ORDER BY event_id LIMIT ?",
+                (limit,)).fetchall()
+        return [tuple(r) for r in rows]
+
+    def ack_events(self, event_ids: list):
+        with self._lock:
+            self._db.executemany("DELETE FROM lead_events WHERE event_id = ?", [(i,) for i in event_ids])
+
+    # ---------- sync verso il foglio ----------
+    def unsynced(self, limit: int = 500) -> list:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM leads WHERE synced_at IS NULL OR synced_at < updated_at "
+                "ORDER BY lead_id LIMIT ?", (limit,)).fetchall()
+        return [self._record(r) for r in rows]
+
+    def mark_synced(self, records: list):
+        """Segna come sincronizzate le versioni lette da unsynced() (se nel frattempo
+        la lead è cambiata resta da sincronizzare)."""
+        with self._lock:
+            self._db.executemany(
+                "UPDATE leads SET synced_at = ? WHERE lead_id = ?",
+                [(r["updated_at"], r["lead_id"]) for r in records],
+            )
+
+    def is_imported(self) -> bool:
+        """True dopo "python sheet_sync.py import": solo da lì lead_id = riga del foglio - 1."""
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM meta WHERE key = 'sheet_imported'").fetchone() is not None
+
+    def import_records(self, records: list) -> int:
+        """Import una tantum dal foglio: records = get_all_records(), la prima riga dati è lead_id 1.
+
+        Le lead create in locale prima dell'import (mai sincronizzate) vengono spostate
+        dopo l'ultima riga del foglio, così non sovrascrivono righe esistenti; i loro
+        lead_events e lead_sales vengono spostati nella stessa transazione.
+        Gli status vengono normalizzati (normalize_status) e le righe corrette riscritte sul foglio.
+        """
+        cols = ", ".join(FIELDS)
+        marks = ", ".join("?" for _ in FIELDS)
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                imported = self._db.execute("SELECT value FROM meta WHERE key = 'sheet_imported'").fetchone()
+                if not imported:
+                    top = self._db.execute("SELECT COALESCE(MAX(lead_id), 0) FROM leads").fetchone()[0]
+                    offset = max(top, len(records))
+                    # updated_at nuovo: lo scheduler rivede le lead spostate col loro nuovo id
+                    self._db.execute(
+                        "UPDATE leads SET lead_id = lead_id + ?, synced_at = NULL, updated_at = ? WHERE lead_id <= ?",
+                        (offset, now, len(records)),
+                    )
+                    # eventi e vendite seguono la lead (non devono puntare alle righe importate)
+                    for table in ("lead_events", "lead_sales"):
+                        self._db.execute(
+                            f"UPDATE {table} SET lead_id = lead_id + ? WHERE lead_id <= ?",
+                            (offset, len(records)),
+                        )
+                added = 0
+                for lead_id, rec in enumerate(records, start=1):
+                    status = normalize_status(rec.get("status"))
+                    cur = self._db.execute(
+                        f"INSERT OR IGNORE INTO leads (lead_id, {cols}, updated_at, synced_at) "
+                        f"VALUES (?, {marks}, ?, ?)",
+                        [lead_id, *self._values({**rec, "status": status}), now,
+                         now if status == rec.get("status") else None],
+                    )
+                    added += cur.rowcount
+                self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('sheet_imported', ?)", (str(now),))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return added
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._db.execute("SELECT COUNT(*) FROM leads").fetchone()[0]
+            unsynced = self._db.execute(
+                "SELECT COUNT(*) FROM leads WHERE synced_at IS NULL OR synced_at < updated_at").fetchone()[0]
+            events = self._db.execute("SELECT COUNT(*) FROM lead_events").fetchone()[0]
+        return {"leads": total, "unsynced": unsynced, "events": events}
+
+
+class LeadCache:
+    """Cache read-through (LRU con TTL) davanti a LeadStore.get: le lead più richieste
+    non toccano nemmeno SQLite. Le modifiche fatte da altri processi si vedono al più
+    dopo ttl secondi; quelle del processo stesso vanno segnalate con invalidate().
+    """
+
+    def __init__(self, store: LeadStore, size: int = LEAD_CACHE_SIZE, ttl: float = LEAD_CACHE_TTL):
+        self.store = store
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()  # lead_id -> (lead, scade_alle)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, lead_id: int):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(lead_id)
+            if item and item[1] > now:
+                self._items.move_to_end(lead_id)
+                self.hits += 1
+                return dict(item[0])
+            self.misses += 1
+        lead = self.store.get(lead_id)
+        if lead is not None:
+            with self._lock:
+                self._items[lead_id] = (lead, now + self.ttl)
+                self._items.move_to_end(lead_id)
+                while len(self._items) > self.size:
+                    self._items.popitem(last=False)
+            lead = dict(lead)
+        return lead
+
+    def invalidate(self, lead_id: int):
+        with self._lock:
+            self._items.pop(lead_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._items)
+        total = self.hits + self.misses
+        return {
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
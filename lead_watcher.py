@@ -1,45 +1,37 @@
-import os, json, time, smtplib
+import os, sys, json, time, smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
-import gspread
-from google.oauth2.service_account import Credentials
 from dotenv import load_dotenv
 import stripe
 
+from lead_store import LeadStore
+from metrics import LatencyStats
+
 load_dotenv()
 
 # === ENV ===
 STRIPE_API_KEY    = os.getenv("STRIPE_SECRET_KEY")
 EMAIL_FROM        = os.getenv("EMAIL_FROM")
 EMAIL_PASS        = os.getenv("EMAIL_APP_PASSWORD")
-GOOGLE_SHEETS_ID  = os.getenv("GOOGLE_SHEETS_ID")
-SHEET_NAME        = os.getenv("SHEET_NAME", "Sheet1")
 
 SMTP_HOST = "smtp.gmail.com"
 SMTP_PORT_SSL = 465
 
-stripe.api_key = STRIPE_API_KEY
-
-# ---------- Helpers Google Sheets ----------
-def ws_readonly():
-    scopes = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
-    creds  = Credentials.from_service_account_file("service_account_Sheet.json", scopes=scopes)
-    gc     = gspread.authorize(creds)
-    return gc.open_by_key(GOOGLE_SHEETS_ID).worksheet(SHEET_NAME)
+# High-water mark: ultimo lead_id già gestito, ad ogni giro si leggono solo le lead dopo
+CHECKPOINT_FILE = os.getenv("WATCHER_CHECKPOINT_FILE", "last_checkpoint.json")
+# Eventi "lead creata" letti ogni WATCHER_EVENT_INTERVAL secondi; il controllo completo resta come rete di sicurezza
+WATCHER_EVENT_INTERVAL = float(os.getenv("WATCHER_EVENT_INTERVAL", "0.2"))
+WATCHER_POLL_INTERVAL  = float(os.getenv("WATCHER_POLL_INTERVAL", "60"))
 
-def ws_readwrite():
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds  = Credentials.from_service_account_file("service_account_Sheet.json", scopes=scopes)
-    gc     = gspread.authorize(creds)
-    return gc.open_by_key(GOOGLE_SHEETS_ID).worksheet(SHEET_NAME)
+stripe.api_key = STRIPE_API_KEY
 
-def update_cell(row_index: int, header_name: str, value: str):
-    ws = ws_readwrite()
-    col = ws.find(header_name).col
-    ws.update_cell(row_index, col, value)
+# Lead store locale (data/leads.db); il foglio viene aggiornato da sheet_sync.py
+store = LeadStore()
+# latenza dalla lead accettata dall'app (LeadQueue.put) all'email partita
+dispatch_latency = LatencyStats()
 
 # ---------- Email ----------
 def send_email(to_email: str, subject: str, body_txt: str):
@@ -55,53 +47,62 @@ def send_email(to_email: str, subject: str, body_txt: str):
         s.login(EMAIL_FROM, EMAIL_PASS)
         s.send_message(msg)
 
-# ---------- Core ----------
-def process_new_leads_once():
-    """Legge il foglio e processa tutte le righe con status == 'nuovo'."""
-    ws = ws_readonly()
-    rows = ws.get_all_records()
+# ---------- Checkpoint ----------
+def load_checkpoint() -> int:
+    try:
+        with open(CHECKPOINT_FILE, "r", encoding="utf-8") as f:
+            return int(json.load(f).get("last_index", 0))
+    except (FileNotFoundError, ValueError, AttributeError):
+        return 0
+
+def save_checkpoint(last_index: int):
+    tmp = CHECKPOINT_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"last_index": last_index}, f)
+    os.replace(tmp, CHECKPOINT_FILE)
 
+# ---------- Core ----------
+def load_first_buyer():
     # carica buyers e prendi il primo
     with open("buyers.json", "r", encoding="utf-8") as f:
         buyers = json.load(f)
     if not buyers or not buyers[0].get("email"):
         print("⚠️ Nessun buyer valido in buyers.json")
-        return
-
-    first_buyer = buyers[0]
-
-    # scorri le righe con indice reale di foglio (2 = prima riga dati)
-    for row_index, lead in enumerate(rows, start=2):
-        status = (lead.get("status") or "").strip().lower()
-        if status != "nuovo":
-            continue
-
-        price_id = lead.get("stripe_price_id")
-        if not price_id:
-            print(f"⚠️ Riga {row_index}: manca stripe_price_id, salto.")
-            continue
-
-        # Crea checkout session (min 30 min per Stripe)
-        try:
-            session = stripe.checkout.Session.create(
-                mode="payment",
-                line_items=[{"price": price_id, "quantity": 1}],
-                success_url="https://example.com/success",
-                cancel_url="https://example.com/cancel",
-                client_reference_id=str(row_index - 1),  # lead_id = indice 1-based
-                metadata={"lead_id": str(row_index - 1), "buyer_index": "0"},
-                expires_at=int(time.time()) + 30 * 60
-            )
-            checkout_url = session.url
-        except Exception as e:
-            print(f"❌ Stripe error riga {row_index}: {e}")
-            continue
-
-        # Prepara email
-        subject = f"Nuovo lead! – {lead.get('service','')}"
-        phone = str(lead.get("phone", ""))
-        masked_phone = phone[:1] + " *** " + phone[-1:] if len(phone) > 5 else "******"
-        body_txt = f"""Hai ricevuto un nuovo lead:
+        return None
+    return buyers[0]
+
+def dispatch_lead(lead: dict, first_buyer: dict):
+    """Checkout Stripe + email al primo buyer + status inviato_<buyer>.
+    Ritorna True se l'email è partita, False su errore (da ritentare), None se la lead va saltata."""
+    lead_id = lead["lead_id"]  # = riga del foglio - 1
+
+    price_id = lead.get("stripe_price_id")
+    if not price_id:
+        # resta "nuovo" ma non viene riletta ad ogni giro (vedi comandi_per_terminale)
+        print(f"⚠️ Lead {lead_id}: manca stripe_price_id, salto.")
+        return None
+
+    # Crea checkout session (min 30 min per Stripe)
+    try:
+        session = stripe.checkout.Session.create(
+            mode="payment",
+            line_items=[{"price": price_id, "quantity": 1}],
+            success_url="https://example.com/success",
+            cancel_url="https://example.com/cancel",
+            client_reference_id=str(lead_id),
+            metadata={"lead_id": str(lead_id), "buyer_index": "0"},
+            expires_at=int(time.time()) + 30 * 60
+        )
+        checkout_url = session.url
+    except Exception as e:
+        print(f"❌ Stripe error lead {lead_id}: {e}")
+        return False
+
+    # Prepara email
+    subject = f"Nuovo lead! – {lead.get('service','')}"
+    phone = str(lead.get("phone", ""))
+    masked_phone = phone[:1] + " *** " + phone[-1:] if len(phone) > 5 else "******"
+    body_txt = f"""Hai ricevuto un nuovo lead:
 
 Servizio: {lead.get('service','')}
 Zona: {lead.get('zone','')}
@@ -113,41 +114,108 @@ Per ricevere il numero completo, procedi al pagamento (entro 30 minuti) cliccand
 {checkout_url}
 """
 
-        # Invia email e aggiorna stato/sent_at
-        try:
-            send_email(first_buyer["email"], subject, body_txt)
-            print(f"✅ Email inviata a {first_buyer['email']} per riga {row_index}")
-        except Exception as e:
-            print(f"❌ Errore invio email riga {row_index}: {e}")
-            # non aggiorno lo stato se la mail non è partita
-            continue
-
-        try:
-            # status -> inviato_<nome buyer>
-            buyer_name = first_buyer.get("name", f"buyer0")
-            update_cell(row_index, "status", f"inviato_{buyer_name.replace(' ', '_')}")
+    # Invia email e aggiorna stato/sent_at
+    try:
+        send_email(first_buyer["email"], subject, body_txt)
+        print(f"✅ Email inviata a {first_buyer['email']} per lead {lead_id}")
+    except Exception as e:
+        print(f"❌ Errore invio email lead {lead_id}: {e}")
+        # non aggiorno lo stato se la mail non è partita
+        return False
+
+    try:
+        # status -> inviato_<nome buyer>
+        buyer_name = first_buyer.get("name", f"buyer0")
+        # solo se è ancora "nuovo" e non venduta: non si sovrascrive una modifica arrivata nel frattempo
+        updated = store.update_if(
+            lead_id,
+            "nuovo",
+            status=f"inviato_{buyer_name.replace(' ', '_')}",
             # sent_at -> ora italiana
-            update_cell(
-                row_index,
-                "sent_at",
-                datetime.now(ZoneInfo("Europe/Rome")).isoformat(timespec="seconds")
-            )
-            print(f"📝 Aggiornati status=inviato_buyer1 e sent_at per riga {row_index}")
-        except Exception as e:
-            print(f"❌ Errore aggiornamento sheet riga {row_index}: {e}")
+            sent_at=datetime.now(ZoneInfo("Europe/Rome")).isoformat(timespec="seconds"),
+        )
+        if updated:
+            print(f"📝 Aggiornati status=inviato_buyer1 e sent_at per lead {lead_id}")
+        else:
+            print(f"ℹ️ Lead {lead_id} cambiata nel frattempo: status lasciato com'è")
+    except Exception as e:
+        print(f"❌ Errore aggiornamento lead {lead_id}: {e}")
+        # email partita: non la si rimanda
+    return True
+
+def process_new_leads_once():
+    """Rete di sicurezza: processa le lead con status == 'nuovo' arrivate dopo il checkpoint.
+
+    Il checkpoint avanza fino alla lead prima del primo errore (Stripe o email):
+    quella lead e le successive vengono ritentate al prossimo giro.
+    """
+    checkpoint = load_checkpoint()
+    rows = store.by_status_after("nuovo", checkpoint)
+    if not rows:
+        return
+
+    first_buyer = load_first_buyer()
+    if not first_buyer:
+        return
+
+    high_water = checkpoint
+    failed = False
+    for lead in rows:
+        if not failed:
+            high_water = lead["lead_id"] - 1
+        if dispatch_lead(lead, first_buyer) is False:
+            failed = True
+        if not failed:
+            high_water = lead["lead_id"]
+
+    if high_water != checkpoint:
+        save_checkpoint(high_water)
+
+def process_events_once() -> int:
+    """Consuma gli eventi "lead creata" pubblicati dallo store all'inserimento.
+    Una lead non inviata resta "nuovo" e la riprende process_new_leads_once()."""
+    events = store.events()
+    if not events:
+        return 0
+
+    first_buyer = load_first_buyer()
+    if not first_buyer:
+        return 0
+
+    for event_id, lead_id, enqueued_at in events:
+        lead = store.get(lead_id)
+        if lead and lead.get("status") == "nuovo" and dispatch_lead(lead, first_buyer):
+            elapsed = time.time() - enqueued_at
+            dispatch_latency.add(elapsed)
+            print(f"⏱️ Lead {lead_id}: {elapsed:.2f}s dalla chiamata all'email")
+        store.ack_events([event_id])
+    return len(events)
 
 def main():
-    print("👀 lead_watcher avviato: controllo ogni 10 minuti per nuove lead (status=nuovo).")
+    if not store.is_imported():
+        # prima dell'import i lead_id locali coincidono con righe storiche del foglio:
+        # i checkout inviati punterebbero alla lead sbagliata dopo la rinumerazione
+        print("⛔ Lead del foglio non ancora importate: eseguire prima 'python sheet_sync.py import'.")
+        sys.exit(1)
+    print(f"👀 lead_watcher avviato: eventi ogni {WATCHER_EVENT_INTERVAL:g}s, "
+          f"controllo completo ogni {WATCHER_POLL_INTERVAL:g}s (status=nuovo).")
+    last_poll = 0.0
     while True:
         try:
-            process_new_leads_once()
+            if time.monotonic() - last_poll >= WATCHER_POLL_INTERVAL:
+                last_poll = time.monotonic()
+                process_new_leads_once()
+                latency = dispatch_latency.stats()
+                if latency["count"]:
+                    print(f"📊 Latenza lead -> email: {latency}")
+            if not process_events_once():
+                time.sleep(WATCHER_EVENT_INTERVAL)
         except KeyboardInterrupt:
             print("👋 Uscita richiesta.")
             break
         except Exception as e:
             print(f"❌ Errore inatteso nel watcher: {e}")
-        # attende 10 minuti
-        time.sleep(1 * 60)
+            time.sleep(WATCHER_EVENT_INTERVAL)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,38 @@
+import threading
+from collections import deque
+
+# =========================
+# Metriche leggere in-process (esposte negli endpoint /health)
+# =========================
+
+
+class LatencyStats:
+    """Ultime N misure di latenza (in secondi) con media e percentili."""
+
+    def __init__(self, size: int = 500):
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._values.append(seconds)
+            self.count += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            values = sorted(self._values)
+            count = self.count
+        if not values:
+            return {"count": count}
+
+        def pct(p):
+            return round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 1)
+
+        return {
+            "count": count,
+            "avg_ms": round(sum(values) / len(values) * 1000, 1),
+            "p50_ms": pct(0.50),
+            "p95_ms": pct(0.95),
+            "max_ms": round(values[-1] * 1000, 1),
+        }
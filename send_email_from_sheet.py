@@ -4,10 +4,10 @@ import json
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-import gspread
-from google.oauth2.service_account import Credentials
 from dotenv import load_dotenv
 
+from gsheets import get_client
+
 # Carica .env
 load_dotenv()
 
@@ -19,9 +19,7 @@ STRIPE_PAYMENT_LINK = "https://buy.stripe.com/test_7sYeVd2sqcQMcbce100sU00"
 
 
 # === 1. Leggi ultimo record da Google Sheet ===
-GS_SCOPES = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
-GS_CREDS = Credentials.from_service_account_file("service_account_Sheet.json", scopes=GS_SCOPES)
-gclient = gspread.authorize(GS_CREDS)
+gclient = get_client()
 
 sh = gclient.open_by_key(GOOGLE_SHEETS_ID)
 ws = sh.worksheet(SHEET_NAME)
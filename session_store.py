@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+# =========================
+# Sessioni delle chiamate (CallSid -> stato IVR)
+# =========================
+# "memory" (default, un solo processo) oppure "redis" (più worker / più host)
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Una chiamata abbandonata sparisce dopo SESSION_TTL secondi senza turni
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+
+
+class MemorySessionStore:
+    """Sessioni in RAM con TTL (rinnovato ad ogni turno) e tetto massimo con eviction LRU."""
+    backend = "memory"
+
+    def __init__(self, ttl: int = SESSION_TTL, max_size: int = SESSION_MAX):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()  # call_sid -> (expires_at, session)
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+    def _purge(self, now: float):
+        # TTL uguale per tutti e rinnovato ad ogni accesso: le più vecchie sono in testa
+        while self._data:
+            call_sid, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[call_sid]
+            self.expired += 1
+
+    async def get(self, call_sid: str):
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            item = self._data.get(call_sid)
+            if item is None:
+                return None
+            self._data[call_sid] = (now + self.ttl, item[1])
+            self._data.move_to_end(call_sid)
+            return item[1]
+
+    async def save(self, call_sid: str, session: dict):
+        now = time.monotonic()
+        with self._lock:
+            self._data[call_sid] = (now + self.ttl, session)
+            self._data.move_to_end(call_sid)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evicted += 1
+
+    async def delete(self, call_sid: str):
+        with self._lock:
+            self._data.pop(call_sid, None)
+
+    async def aclose(self):
+        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl_s": self.ttl,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+
+class RedisSessionStore:
+    """Sessioni su Redis (JSON + scadenza lato server): condivise tra worker e host.
+
+    Il client è iniettabile (es. fakeredis.aioredis.FakeRedis); di default si usa
+    redis.asyncio con REDIS_URL (pip install redis).
+    """
+    backend = "redis"
+
+    def __init__(self, client=None, url: str = REDIS_URL, ttl: int = SESSION_TTL, prefix: str = "voicebot:session:"):
+        if client is None:
+            import redis.asyncio as aioredis
+            client = aioredis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, call_sid: str) -> str:
+        return self.prefix + call_sid
+
+    async def get(self, call_sid: str):
+        raw = await self.client.get(self._key(call_sid))
+        if raw is None:
+            return None
+        await self.client.expire(self._key(call_sid), self.ttl)
+        return json.loads(raw)
+
+    async def save(self, call_sid: str, session: dict):
+        await self.client.set(self._key(call_sid), json.dumps(session, ensure_ascii=False), ex=self.ttl)
+
+    async def delete(self, call_sid: str):
+        await self.client.delete(self._key(call_sid))
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, "ttl_s": self.ttl, "prefix": self.prefix}
+
+
+def build_session_store():
+    if SESSION_STORE == "redis":
+        print("[Sessioni] Backend Redis")
+        return RedisSessionStore()
+    return MemorySessionStore()
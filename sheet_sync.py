@@ -0,0 +1,76 @@
+import os, sys, time
+
+from dotenv import load_dotenv
+
+from lead_store import LeadStore, FIELDS
+from gsheets import WorksheetHandle, get_client, client_stats
+
+load_dotenv()
+
+# === ENV ===
+GOOGLE_SHEETS_ID    = os.getenv("GOOGLE_SHEETS_ID")
+SHEET_NAME          = os.getenv("SHEET_NAME", "Sheet1")
+SHEET_SYNC_INTERVAL = float(os.getenv("SHEET_SYNC_INTERVAL", "5"))
+
+# Specchio in sola scrittura: lo store (data/leads.db) è il riferimento,
+# le modifiche fatte a mano sul foglio vengono sovrascritte al prossimo cambio della lead.
+
+
+# ---------- Helpers Google Sheets ----------
+def open_sheet() -> WorksheetHandle:
+    return WorksheetHandle(get_client(), GOOGLE_SHEETS_ID, SHEET_NAME, list(FIELDS.values()))
+
+
+# ---------- Core ----------
+def sync_once(store: LeadStore, sheet: WorksheetHandle) -> int:
+    """Scrive sul foglio le lead nuove o cambiate con un solo batch_update; riga del foglio = lead_id + 1."""
+    if not store.is_imported():
+        raise RuntimeError("Import dal foglio mai eseguito: 'python sheet_sync.py import'")
+    records = store.unsynced()
+    if not records:
+        return 0
+
+    # colonne nell'ordine del foglio: la mappa header -> colonna è in cache nell'handle
+    sheet.update_records({rec["lead_id"] + 1: rec for rec in records})
+    store.mark_synced(records)
+    return len(records)
+
+
+def import_from_sheet(store: LeadStore):
+    """Migrazione una tantum: copia nello store le lead già presenti sul foglio."""
+    records = open_sheet().worksheet().get_all_records()
+    added = store.import_records(records)
+    print(f"📥 Import completato: {added} lead nuove su {len(records)} righe del foglio.")
+
+
+def main():
+    store = LeadStore()
+    if len(sys.argv) > 1 and sys.argv[1] == "import":
+        import_from_sheet(store)
+        return
+
+    if not store.is_imported():
+        # senza import le lead locali (lead_id 1, 2, ...) sovrascriverebbero le righe già nel foglio
+        print("⛔ Lead del foglio non ancora importate: eseguire prima 'python sheet_sync.py import'.")
+        sys.exit(1)
+
+    print(f"🔄 sheet_sync avviato: specchio delle lead sul foglio ogni {SHEET_SYNC_INTERVAL:g}s.")
+    sheet = None
+    while True:
+        try:
+            if sheet is None:
+                sheet = open_sheet()
+            synced = sync_once(store, sheet)
+            if synced:
+                print(f"📝 {synced} lead sincronizzate sul foglio (client Google: {client_stats()})")
+        except KeyboardInterrupt:
+            print("👋 Uscita richiesta.")
+            break
+        except Exception as e:
+            print(f"❌ Errore sync foglio: {e} (client Google: {client_stats()})")
+            sheet = None  # riapre il foglio al prossimo giro (il client resta quello condiviso)
+        time.sleep(SHEET_SYNC_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import asyncio
+
+# =========================
+# Single-flight: una sola esecuzione per chiave alla volta
+# =========================
+
+
+class SingleFlight:
+    """Le coroutine concorrenti con la stessa chiave aspettano il task già in corso
+    e ne ricevono lo stesso risultato (o la stessa eccezione).
+
+    Il task è condiviso e protetto da shield: se la richiesta che l'ha avviato
+    viene cancellata (es. Twilio chiude la connessione) gli altri non ne risentono.
+    """
+
+    def __init__(self):
+        self._tasks = {}  # key -> asyncio.Task (o future di begin()) in corso
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn):
+        task = self._tasks.get(key)
+        if task is None or task.done():  # finito ma callback di pulizia non ancora eseguita
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            self.executed += 1
+            task.add_done_callback(lambda t, key=key: self._done(key, t))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def begin(self, key: str):
+        """Per chi produce il risultato da sé (es. uno streaming): registra sotto la chiave un
+        future da completare a mano, che gli altri aspettano come un task. None se la chiave
+        è già in corso."""
+        task = self._tasks.get(key)
+        if task is not None and not task.done():
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self._tasks[key] = future
+        self.executed += 1
+        future.add_done_callback(lambda f, key=key: self._done(key, f))
+        return future
+
+    def running(self, key: str) -> bool:
+        return key in self._tasks
+
+    def _done(self, key: str, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            task.exception()  # evita "Task exception was never retrieved"
+
+    def stats(self) -> dict:
+        return {
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._tasks),
+        }
@@ -1,15 +1,17 @@
-import os, smtplib, json
+import os, sys, time, smtplib, json
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 from flask import Flask, request
 from dotenv import load_dotenv
 import stripe
-import gspread
-from google.oauth2.service_account import Credentials
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
+from lead_store import LeadStore, LeadCache
+from metrics import LatencyStats
+from webhook_queue import WebhookQueue, FulfillmentError, WEBHOOK_LEASE
+
 load_dotenv()
 
 # === ENV ===
@@ -18,41 +20,36 @@ STRIPE_API_KEY   = os.getenv("STRIPE_SECRET_KEY")
 
 EMAIL_FROM       = os.getenv("EMAIL_FROM")
 EMAIL_PASS       = os.getenv("EMAIL_APP_PASSWORD")
-GOOGLE_SHEETS_ID = os.getenv("GOOGLE_SHEETS_ID")
-SHEET_NAME       = os.getenv("SHEET_NAME", "Sheet1")
 
 SMTP_HOST = "smtp.gmail.com"
 SMTP_PORT_SSL = 465
+# Timeout di ogni operazione SMTP (connessione, login, invio), ben sotto il lease della coda:
+# un invio bloccato oltre il lease farebbe riprendere l'evento a un altro worker (email doppia)
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", str(WEBHOOK_LEASE / 6)))
 
 stripe.api_key = STRIPE_API_KEY
 app = Flask(__name__)
 
+# Lead store locale (data/leads.db); il foglio viene aggiornato da sheet_sync.py
+store = LeadStore()
+# lookup per id: chiave primaria dello store + piccola cache, indipendente da quante lead ci sono
+leads = LeadCache(store)
 
-def update_lead_status(row_index: int, status: str):
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds  = Credentials.from_service_account_file("service_account_Sheet.json", scopes=scopes)
-    gc     = gspread.authorize(creds)
-    ws     = gc.open_by_key(GOOGLE_SHEETS_ID).worksheet(SHEET_NAME)
-    ws.update_cell(row_index, ws.find("status").col, status)
-    print(f"✅ Lead alla riga {row_index} aggiornato a status={status}")
 
-def update_lead_field(row_index: int, header_name: str, value: str):
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds  = Credentials.from_service_account_file("service_account_Sheet.json", scopes=scopes)
-    gc     = gspread.authorize(creds)
-    ws     = gc.open_by_key(GOOGLE_SHEETS_ID).worksheet(SHEET_NAME)
-    col    = ws.find(header_name).col
-    ws.update_cell(row_index, col, value)
-    print(f"✅ Lead riga {row_index}: {header_name} = {value}")
+def mark_lead_sold(lead_id: int, event_id: str, status: str, sold_at: str) -> dict:
+    """Vendita con lock per lead: solo il primo evento pagato la ottiene (vedi LeadStore.claim_sale)."""
+    sale = store.claim_sale(lead_id, event_id, status, sold_at)
+    leads.invalidate(lead_id)
+    if sale["event_id"] == event_id:
+        print(f"✅ Lead {lead_id} aggiornato a status={sale['status']}, sold_at={sale['sold_at']}")
+    return sale
 
 
 def read_lead_by_id(lead_id: int):
-    scopes = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
-    creds  = Credentials.from_service_account_file("service_account_Sheet.json", scopes=scopes)
-    gc     = gspread.authorize(creds)
-    ws     = gc.open_by_key(GOOGLE_SHEETS_ID).worksheet(SHEET_NAME)
-    rows   = ws.get_all_records()
-    return rows[lead_id - 1]  # 1-based
+    lead = leads.get(lead_id)
+    if lead is None:
+        raise KeyError(f"Lead {lead_id} non trovata")
+    return lead
 
 
 def send_email(to_email: str, subject: str, body_txt: str):
@@ -62,15 +59,97 @@ def send_email(to_email: str, subject: str, body_txt: str):
     msg["Subject"] = subject
     msg.attach(MIMEText(body_txt, "plain", "utf-8"))
 
-    with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT_SSL) as s:
+    with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT_SSL, timeout=SMTP_TIMEOUT) as s:
         s.login(EMAIL_FROM, EMAIL_PASS)
         s.send_message(msg)
 
     print("📧 Email inviata a:", to_email)
 
 
+def fulfill_checkout(event: dict):
+    """Fulfillment di checkout.session.completed (nei worker della coda, con retry)."""
+    session = event["data"]["object"]
+
+    # ✅ Controlla che il pagamento sia stato effettivamente completato
+    if session.get("payment_status") != "paid":
+        print(f"⚠️ Session completata ma non pagata (status={session.get('payment_status')})")
+        return
+
+    lead_id = session.get("client_reference_id") or (session.get("metadata") or {}).get("lead_id")
+    buyer_index = (session.get("metadata") or {}).get("buyer_index")
+
+    print("🔗 Lead ID:", lead_id)
+    print("🏷️ Buyer index:", buyer_index)
+
+    if not lead_id or buyer_index is None:
+        return
+
+    # Carica il buyer corretto da buyers.json
+    try:
+        with open("buyers.json", "r", encoding="utf-8") as f:
+            buyers = json.load(f)
+        buyer_index = int(buyer_index)
+        buyer = buyers[buyer_index]
+        buyer_name = buyer.get("name", f"buyer{buyer_index}")
+        buyer_email = buyer.get("email")
+    except Exception as e:
+        raise FulfillmentError(f"Errore recupero buyer: {e}")
+
+    # recupera la lead
+    try:
+        lead_id = int(lead_id)
+        lead = read_lead_by_id(lead_id)
+    except (KeyError, ValueError) as e:
+        raise FulfillmentError(f"Lead {lead_id} non valida: {e}")
+    phone_full = str(lead.get("phone", ""))
+
+    # Prima la vendita (status + sold_at, una volta sola), poi l'email: un secondo buyer
+    # che paga la stessa lead, o un retry dello stesso evento, non la rivende
+    sold_at_value = datetime.now(ZoneInfo("Europe/Rome")).isoformat(timespec="seconds")
+    sale = mark_lead_sold(lead_id, event["id"], f"venduto_{buyer_name}", sold_at_value)
+    if sale["event_id"] != event["id"]:
+        raise FulfillmentError(
+            f"Lead {lead_id} già venduta ({sale['status']}): pagamento di {buyer_name} da rimborsare")
+    if sale["emailed_at"]:
+        print(f"ℹ️ Lead {lead_id}: email a {buyer_name} già inviata il {sale['emailed_at']}")
+        return
+
+    subject = f"Dettagli lead sbloccati – {lead.get('service','')}"
+    body = f"""Grazie per il pagamento {buyer_name}!
+
+Dettagli completi del lead:
+- Servizio: {lead.get('service','')}
+- Zona: {lead.get('zone','')}
+- Tempistica: {lead.get('timing','')}
+- Telefono: {phone_full}
+- Prezzo: {lead.get('€','')}
+"""
+
+    # Invia al buyer corretto (non al payer_email di Stripe!)
+    send_email(buyer_email, subject, body)
+    store.mark_sale_emailed(lead_id, datetime.now(ZoneInfo("Europe/Rome")).isoformat(timespec="seconds"))
+
+
+# Eventi salvati su data/stripe_events.db e processati in background
+events = WebhookQueue(fulfill_checkout)
+# tempo dalla richiesta di Stripe al 200 (verifica firma + scrittura su disco)
+ack_latency = LatencyStats()
+
+
+@app.before_request
+def start_workers():
+    # i worker partono alla prima richiesta: vale con e senza reloader (il processo padre
+    # del reloader non serve richieste) e sotto un server WSGI che importa solo "app".
+    # Prima dell'import dal foglio i lead_id dei checkout non sono affidabili: gli eventi
+    # restano in coda su disco e vengono processati quando l'import è stato fatto.
+    if events.running() or not store.is_imported():
+        return
+    events.start()
+
+
 @app.post("/stripe/webhook")
 def stripe_webhook():
+    started = time.perf_counter()
     payload    = request.data
     sig_header = request.headers.get("Stripe-Signature", "")
 
@@ -90,59 +169,29 @@ def stripe_webhook():
     print(f"✅ Evento ricevuto: {event['type']}")
 
     if event["type"] == "checkout.session.completed":
-        session = event["data"]["object"]
-
-        # ✅ Controlla che il pagamento sia stato effettivamente completato
-        if session.get("payment_status") != "paid":
-            print(f"⚠️ Session completata ma non pagata (status={session.get('payment_status')})")
-            return "ok", 200
-
-        lead_id = session.get("client_reference_id") or (session.get("metadata") or {}).get("lead_id")
-        buyer_index = (session.get("metadata") or {}).get("buyer_index")
-
-        print("🔗 Lead ID:", lead_id)
-        print("🏷️ Buyer index:", buyer_index)
-
-        if lead_id and buyer_index is not None:
-            # Carica il buyer corretto da buyers.json
-            try:
-                with open("buyers.json", "r", encoding="utf-8") as f:
-                    buyers = json.load(f)
-                buyer_index = int(buyer_index)
-                buyer = buyers[buyer_index]
-                buyer_name = buyer.get("name", f"buyer{buyer_index}")
-                buyer_email = buyer.get("email")
-            except Exception as e:
-                print(f"❌ Errore recupero buyer: {e}")
-                return "Invalid buyer", 400
-
-            # recupera la lead
-            lead = read_lead_by_id(int(lead_id))
-            phone_full = str(lead.get("phone", ""))
-
-            subject = f"Dettagli lead sbloccati – {lead.get('service','')}"
-            body = f"""Grazie per il pagamento {buyer_name}!
-
-Dettagli completi del lead:
-- Servizio: {lead.get('service','')}
-- Zona: {lead.get('zone','')}
-- Tempistica: {lead.get('timing','')}
-- Telefono: {phone_full}
-- Prezzo: {lead.get('€','')}
-"""
-
-            # Invia al buyer corretto (non al payer_email di Stripe!)
-            send_email(buyer_email, subject, body)
+        # risposta subito: email e aggiornamento della lead li fanno i worker
+        try:
+            if events.put(json.loads(payload)) is None:
+                print(f"🔁 Evento {event['id']} già ricevuto, ignorato")
+        except Exception as e:
+            print("❌ Errore salvataggio evento:", e)
+            return "Queue error", 500  # Stripe riproverà
+
+    ack_latency.add(time.perf_counter() - started)
+    return "ok", 200
 
-            # Aggiorna status con il nome reale del buyer
-            row_index = int(lead_id) + 1  # header +1
-            update_lead_status(row_index, f"venduto_{buyer_name}")
-            # Scrivi anche la data/ora della vendita
-            sold_at_value = datetime.now(ZoneInfo("Europe/Rome")).isoformat(timespec="seconds")
-            update_lead_field(row_index, "sold_at", sold_at_value)
 
-    return "ok", 200
+@app.get("/stripe/stats")
+def stripe_stats():
+    return {
+        "queue": events.stats(),
+        "ack_latency": ack_latency.stats(),
+        "lead_cache": leads.stats(),
+    }
 
 
 if __name__ == "__main__":
+    if not store.is_imported():
+        print("⛔ Lead del foglio non ancora importate: eseguire prima 'python sheet_sync.py import'.")
+        sys.exit(1)
     app.run(port=4242, debug=True)
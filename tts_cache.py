@@ -0,0 +1,120 @@
+import os
+import hashlib
+import threading
+from pathlib import Path
+
+# =========================
+# Cache TTS su disco (content-addressed)
+# =========================
+TTS_CACHE_DIR = Path(os.getenv("TTS_CACHE_DIR", "data/tts_cache"))
+TTS_CACHE_MAX_MB = float(os.getenv("TTS_CACHE_MAX_MB", "200"))
+
+
+class TTSCache:
+    """Audio TTS salvato su file, chiave = hash di (provider, voce, lingua, encoding, testo).
+
+    Limite di dimensione con eviction LRU: l'mtime del file viene aggiornato
+    ad ogni hit, quindi i file più vecchi sono quelli usati meno di recente.
+    """
+
+    def __init__(self, root: Path = TTS_CACHE_DIR, max_bytes: int = int(TTS_CACHE_MAX_MB * 1024 * 1024)):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._size = sum(p.stat().st_size for p in self.root.glob("*.audio"))
+
+    @staticmethod
+    def make_key(provider: str, voice: str, language: str, encoding: str, text: str) -> str:
+        raw = "\x1f".join([provider, voice, language, encoding, text])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def path_for(self, key: str) -> Path:
+        return self.root / f"{key}.audio"
+
+    def contains(self, key: str) -> bool:
+        """Come lookup() ma senza toccare contatori e LRU (usato dal warm-up)."""
+        return self.path_for(key).exists()
+
+    def lookup(self, keys):
+        """Cerca tra più chiavi alternative: ritorna (key, Path) della prima presente
+        oppure None. Conta un solo hit/miss per lookup e aggiorna l'LRU."""
+        for key in keys:
+            path = self.path_for(key)
+            try:
+                os.utime(path)  # bump LRU
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                self.hits += 1
+            return key, path
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, data: bytes) -> Path:
+        path = self.path_for(key)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        with self._lock:
+            # chiave già presente (worker concorrenti, prefetch ripetuto): conta solo la differenza
+            try:
+                old_size = path.stat().st_size
+            except FileNotFoundError:
+                old_size = 0
+            os.replace(tmp, path)  # scrittura atomica, sicura con più worker
+            self._size += len(data) - old_size
+            over = self._size > self.max_bytes
+        if over:
+            self._evict()
+        return path
+
+    def discard(self, key: str):
+        """Rimuove un file dalla cache (es. audio di riserva sostituito dalla voce principale)."""
+        path = self.path_for(key)
+        with self._lock:
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except OSError:  # già rimosso, o ancora aperto in lettura (Windows): lo toglierà l'eviction
+                return
+            self._size -= size
+
+    def _evict(self):
+        with self._lock:
+            files = []
+            for p in self.root.glob("*.audio"):
+                try:
+                    st = p.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, p))
+            files.sort()
+            total = sum(size for _, size, _ in files)
+            # scende al 90% del limite per non rifare eviction ad ogni put
+            target = int(self.max_bytes * 0.9)
+            for _, size, p in files:
+                if total <= target:
+                    break
+                try:
+                    p.unlink()
+                    self.evictions += 1
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._size = total
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "evictions": self.evictions,
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,319 @@
+import os
+import time
+import asyncio
+
+from tts_cache import TTSCache
+from singleflight import SingleFlight
+from tts_providers import (
+    ElevenLabsTTS, GoogleTTS, LocalTTS, TTSError, TTSBusy,
+    synthesize_bounded, open_stream, TTS_OUTPUT_PROFILE,
+)
+
+# =========================
+# Motore TTS multi-provider (hedging + circuit breaker)
+# =========================
+# Ordine di preferenza dei provider, es. "google,elevenlabs,local"
+TTS_PROVIDERS = os.getenv("TTS_PROVIDERS", "")
+# Dopo quanti secondi senza risposta parte in parallelo il provider successivo
+TTS_HEDGE_DELAY = float(os.getenv("TTS_HEDGE_DELAY", "1.5"))
+# Fallimenti consecutivi che aprono il circuito, e per quanto resta aperto
+TTS_BREAKER_FAILURES = int(os.getenv("TTS_BREAKER_FAILURES", "3"))
+TTS_BREAKER_RESET = float(os.getenv("TTS_BREAKER_RESET", "30"))
+
+
+class StreamAborted(TTSError):
+    """Lo streaming a cui si erano accodate altre richieste si è interrotto (es. Twilio ha chiuso)."""
+
+
+class CircuitBreaker:
+    """closed -> open dopo N errori di fila; dopo reset_after secondi lascia passare
+    una richiesta di prova (half-open): se va bene si richiude."""
+
+    def __init__(self, failure_threshold: int = TTS_BREAKER_FAILURES, reset_after: float = TTS_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        return self.state != "open"
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half-open" or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                self.trips += 1
+            self.opened_at = time.monotonic()
+
+
+class TTSEngine:
+    """Sintesi con più provider in ordine di preferenza.
+
+    - cache su disco condivisa (ogni provider ha le sue chiavi);
+    - single-flight per testo;
+    - hedging: se il provider in corso non risponde entro hedge_delay parte anche
+      il successivo e vince il primo che risponde; se fallisce si passa subito al successivo;
+    - circuit breaker per provider: quelli che falliscono di continuo vengono saltati.
+    """
+
+    def __init__(self, providers: list, cache: TTSCache, hedge_delay: float = TTS_HEDGE_DELAY):
+        if not providers:
+            raise RuntimeError("Nessun provider TTS configurato")
+        self.providers = providers
+        self.cache = cache
+        self.hedge_delay = hedge_delay
+        self.breakers = {p.name: CircuitBreaker() for p in providers}
+        self.flight = SingleFlight()
+        self._refreshing = {}  # chiave primaria -> task che rifà l'audio col provider primario
+        self.primary_refreshes = 0
+        self.hedges = 0
+        self.wins = {p.name: 0 for p in providers}
+        self.errors = {p.name: 0 for p in providers}
+
+    def text_key(self, text: str) -> str:
+        """Chiave indipendente dal provider che ha risposto (per single-flight e URL statici).
+        Deriva dalle chiavi di cache dei provider: cambia se cambiano voce, modello o formato."""
+        keys = ",".join(p.cache_key(text) for p in self.providers)
+        return TTSCache.make_key("engine", keys, "", TTS_OUTPUT_PROFILE, text)
+
+    def cached(self, text: str):
+        """(Path, provider) dell'audio già in cache, preferendo il provider primario.
+
+        Un hit di un provider di riserva viene servito (meglio che aspettare), ma parte in
+        background la sintesi col primario: appena pronta sostituisce l'audio di riserva.
+        """
+        by_key = {p.cache_key(text): p for p in self.providers}
+        hit = self.cache.lookup(by_key)
+        if hit is None:
+            return None
+        key, path = hit
+        provider = by_key[key]
+        if not self.is_primary(provider):
+            self._refresh_primary(text)
+        return path, provider
+
+    def is_primary(self, provider) -> bool:
+        return provider is self.providers[0]
+
+    def is_cached(self, text: str) -> bool:
+        """Audio pronto per warm-up e prefetch: quello del provider primario. Se il primario sta
+        fallendo va bene anche quello di riserva, invece di rifarlo ad ogni turno: il ritorno
+        alla voce principale lo fa _refresh_primary (che rispetta il circuit breaker)."""
+        primary = self.providers[0]
+        if self.cache.contains(primary.cache_key(text)):
+            return True
+        if not self.breakers[primary.name].failures:
+            return False
+        return any(self.cache.contains(p.cache_key(text)) for p in self.providers[1:])
+
+    def _refresh_primary(self, text: str):
+        primary = self.providers[0]
+        key = primary.cache_key(text)
+        if key in self._refreshing or not self.breakers[primary.name].allow():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:  # fuori dall'event loop (es. CLI): ci penserà il prossimo warm-up
+            return
+        self._refreshing[key] = loop.create_task(self._refresh_one(primary, text, key))
+
+    async def _refresh_one(self, primary, text: str, key: str):
+        try:
+            audio = await synthesize_bounded(primary, text)
+        except Exception as e:
+            self.breakers[primary.name].record_failure()
+            self.errors[primary.name] += 1
+            print(f"ERRORE TTS {primary.name} (ritorno alla voce principale):", e)
+            return
+        finally:
+            self._refreshing.pop(key, None)
+        self.breakers[primary.name].record_success()
+        self.cache.put(key, audio)
+        # l'audio di riserva non serve più: non resta in cache grazie agli hit passati
+        for p in self.providers[1:]:
+            self.cache.discard(p.cache_key(text))
+        self.primary_refreshes += 1
+
+    def running(self, text: str) -> bool:
+        return self.flight.running(self.text_key(text))
+
+    def _candidates(self) -> list:
+        # se tutti i circuiti sono aperti si prova comunque (meglio un tentativo che il silenzio)
+        return [p for p in self.providers if self.breakers[p.name].allow()] or list(self.providers)
+
+    async def synthesize(self, text: str):
+        """Ritorna (audio, provider che l'ha prodotto); l'audio viene anche salvato in cache.
+        Se per lo stesso testo c'è uno streaming in corso si aspetta quello."""
+        key = self.text_key(text)
+        try:
+            return await self.flight.do(key, lambda: self._hedged(text))
+        except StreamAborted:
+            # lo streaming atteso non è arrivato in fondo: sintesi normale (sempre single-flight)
+            return await self.flight.do(key, lambda: self._hedged(text))
+
+    async def _hedged(self, text: str):
+        candidates = self._candidates()
+        pending = {}  # task -> provider
+        errors = []
+        next_idx = 0
+
+        def launch_next():
+            nonlocal next_idx
+            if next_idx < len(candidates):
+                provider = candidates[next_idx]
+                next_idx += 1
+                pending[asyncio.ensure_future(synthesize_bounded(provider, text))] = provider
+
+        launch_next()
+        try:
+            while pending:
+                can_hedge = next_idx < len(candidates)
+                done, _ = await asyncio.wait(
+                    pending, timeout=self.hedge_delay if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    # il provider in corso è lento: parte anche il successivo
+                    self.hedges += 1
+                    launch_next()
+                    continue
+                for task in done:
+                    provider = pending.pop(task)
+                    try:
+                        audio = task.result()
+                    except Exception as e:
+                        if not isinstance(e, TTSBusy):  # provider saturo, non guasto
+                            self.breakers[provider.name].record_failure()
+                        self.errors[provider.name] += 1
+                        errors.append(f"{provider.name}: {e}")
+                        print(f"ERRORE TTS {provider.name}:", e)
+                        launch_next()  # failover immediato
+                        continue
+                    self.breakers[provider.name].record_success()
+                    self.wins[provider.name] += 1
+                    self.cache.put(provider.cache_key(text), audio)
+                    return audio, provider
+        finally:
+            for task in pending:
+                task.cancel()
+        raise TTSError("Nessun provider TTS disponibile: " + "; ".join(errors))
+
+    async def open_stream(self, text: str, ttfb, started: float):
+        """Streaming dal primo provider disponibile (failover solo prima del primo byte).
+        Ritorna (async iterator, provider); l'iteratore va sempre chiuso con aclose().
+
+        Lo streaming è registrato nel single-flight: le richieste concorrenti per lo stesso
+        testo (synthesize) aspettano l'audio completo invece di aprire altri stream.
+        """
+        flight = self.flight.begin(self.text_key(text))
+        if flight is None:  # nel frattempo è partita un'altra sintesi: si aspetta quella
+            audio, provider = await self.synthesize(text)
+            return self._single_chunk(audio), provider
+
+        errors = []
+        for provider in self._candidates():
+            key = provider.cache_key(text)
+
+            def on_complete(audio, key=key, provider=provider):
+                self.cache.put(key, audio)
+                if not flight.done():
+                    flight.set_result((audio, provider))
+
+            def on_close():
+                # stream non arrivato in fondo (o mai iniziato): chi aspettava rifà la sintesi
+                if not flight.done():
+                    flight.set_exception(StreamAborted("Streaming interrotto"))
+
+            try:
+                body = await open_stream(provider, text, on_complete, ttfb, started, on_close)
+            except BaseException as e:
+                if not isinstance(e, Exception):  # cancellazione: chi aspetta rifà la sintesi
+                    flight.set_exception(StreamAborted("Streaming annullato"))
+                    raise
+                if not isinstance(e, TTSBusy):
+                    self.breakers[provider.name].record_failure()
+                self.errors[provider.name] += 1
+                errors.append(f"{provider.name}: {e}")
+                print(f"ERRORE TTS stream {provider.name}:", e)
+                continue
+            self.breakers[provider.name].record_success()
+            self.wins[provider.name] += 1
+            return body, provider
+        error = TTSError("Nessun provider TTS disponibile: " + "; ".join(errors))
+        flight.set_exception(error)
+        raise error
+
+    @staticmethod
+    async def _single_chunk(audio: bytes):
+        yield audio
+
+    async def start(self):
+        for p in self.providers:
+            await p.start()
+
+    async def aclose(self):
+        for task in list(self._refreshing.values()):
+            task.cancel()
+        for p in self.providers:
+            await p.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "providers": [
+                {
+                    "name": p.name,
+                    "circuit": self.breakers[p.name].state,
+                    "trips": self.breakers[p.name].trips,
+                    "wins": self.wins[p.name],
+                    "errors": self.errors[p.name],
+                    **p.stats(),
+                }
+                for p in self.providers
+            ],
+            "hedges": self.hedges,
+            "primary_refreshes": self.primary_refreshes,
+            "hedge_delay_s": self.hedge_delay,
+            "singleflight": self.flight.stats(),
+        }
+
+
+def build_engine(cache: TTSCache, default_order: str, eleven_api_key: str = "", eleven_voice_id: str = "") -> TTSEngine:
+    """Crea i provider configurati nell'ordine di TTS_PROVIDERS (o default_order).
+
+    I provider cloud senza credenziali vengono saltati; "local" c'è sempre se richiesto.
+    """
+    providers = []
+    for name in (TTS_PROVIDERS or default_order).split(","):
+        name = name.strip().lower()
+        if name == "elevenlabs":
+            if eleven_api_key:
+                providers.append(ElevenLabsTTS(eleven_api_key, eleven_voice_id))
+            else:
+                print("[TTS] ElevenLabs saltato: ELEVEN_API_KEY mancante")
+        elif name == "google":
+            if not os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
+                print("[TTS] Google saltato: GOOGLE_APPLICATION_CREDENTIALS mancante")
+                continue
+            try:
+                providers.append(GoogleTTS())
+            except ImportError:
+                print("[TTS] Google saltato: google-cloud-texttospeech non installato")
+        elif name == "local":
+            providers.append(LocalTTS())
+        elif name:
+            print(f"[TTS] provider sconosciuto: {name}")
+    print("[TTS] Provider attivi:", ", ".join(p.name for p in providers) or "nessuno")
+    return TTSEngine(providers, cache)
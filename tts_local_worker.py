@@ -0,0 +1,39 @@
+import io
+import time
+
+# =========================
+# Worker Coqui TTS (gira nei processi del pool di LocalTTS, mai nel processo uvicorn)
+# =========================
+_model = None
+_model_name = None
+
+
+def init(model_name: str):
+    """Initializer del pool: salva solo il nome, il modello si carica al primo job."""
+    global _model_name
+    _model_name = model_name
+
+
+def _load():
+    global _model
+    if _model is None:
+        from TTS.api import TTS
+        print(f"[Local TTS] Caricamento modello {_model_name}...")
+        _model = TTS(_model_name)
+    return _model
+
+
+def warm_up() -> float:
+    """Carica il modello nel processo; ritorna i secondi impiegati."""
+    started = time.perf_counter()
+    _load()
+    return time.perf_counter() - started
+
+
+def synthesize(text: str) -> bytes:
+    model = _load()
+    speaker = model.speakers[0] if getattr(model, "speakers", None) else None
+    wav = model.tts(text=text, speaker=speaker, language="it")
+    buf = io.BytesIO()
+    model.synthesizer.save_wav(wav, buf)
+    return buf.getvalue()
@@ -0,0 +1,137 @@
+import os
+import asyncio
+import threading
+
+# =========================
+# Registro prompt statici IVR
+# =========================
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Chiamate di cui si ricordano i prompt attesi (se manca lo status callback si scartano le più vecchie)
+PREFETCH_MAX_CALLS = int(os.getenv("PREFETCH_MAX_CALLS", "1000"))
+
+
+class PromptRegistry:
+    """Prompt fissi dell'IVR (nome -> testo), pre-sintetizzati e serviti come URL statici.
+
+    L'URL contiene un prefisso della chiave di cache, quindi se cambia testo o voce
+    cambia anche l'URL e Twilio non riusa audio vecchio.
+    """
+
+    def __init__(self, prompts: dict):
+        self.prompts = dict(prompts)
+        self._names = {text: name for name, text in self.prompts.items()}
+        self._keys = {}  # name -> cache key dell'audio già pronto
+        self._lock = threading.Lock()
+        # prefetch: prompt attesi per chiamata (CallSid -> nomi attesi degli ultimi due turni:
+        # il turno appena risposto, non ancora ascoltato, e il successivo) e task in corso
+        self._expected = {}
+        self._tasks = set()
+        self.prefetch_started = 0
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+
+    def name_for(self, text: str):
+        return self._names.get(text)
+
+    def text_for(self, name: str):
+        return self.prompts.get(name)
+
+    def static_path(self, text: str):
+        """Path statico del prompt se l'audio è già stato renderizzato, altrimenti None."""
+        name = self._names.get(text)
+        if not name:
+            return None
+        with self._lock:
+            key = self._keys.get(name)
+        if not key:
+            return None
+        return f"/tts/static/{name}/{key[:16]}"
+
+    def is_current(self, name: str, version: str) -> bool:
+        """False per URL statici di una versione precedente (testo o voce cambiati)."""
+        with self._lock:
+            key = self._keys.get(name)
+        return bool(key) and key[:16] == version
+
+    async def warm_up(self, engine) -> int:
+        """Sintetizza con il motore TTS i prompt non ancora in cache. Ritorna quanti sono stati sintetizzati."""
+        rendered = 0
+        for name, text in self.prompts.items():
+            if not engine.is_cached(text):
+                try:
+                    await engine.synthesize(text)
+                    rendered += 1
+                except Exception as e:
+                    print(f"[TTS warm-up] errore prompt '{name}':", e)
+                    continue
+            with self._lock:
+                self._keys[name] = engine.text_key(text)
+        print(f"[TTS warm-up] {len(self._keys)}/{len(self.prompts)} prompt pronti ({rendered} sintetizzati)")
+        return rendered
+
+    def prefetch(self, call_sid: str, names, engine):
+        """Sintesi in background dei prompt probabili al prossimo turno, mentre il chiamante parla.
+        Le attese più vecchie di due turni della stessa chiamata si scartano (quel prompt è
+        già stato chiesto, o non lo sarà più). Va chiamata dentro l'event loop (handler async)."""
+        names = [name for name in names if name in self.prompts]
+        with self._lock:
+            turns = [t for t in self._expected.pop(call_sid, [])[-1:] if t]
+            turns.append(set(names))
+            self._expected[call_sid] = turns
+            while len(self._expected) > PREFETCH_MAX_CALLS:
+                del self._expected[next(iter(self._expected))]
+        for name in names:
+            text = self.prompts[name]
+            if engine.is_cached(text) or engine.running(text):
+                continue
+            self.prefetch_started += 1
+            task = asyncio.create_task(self._prefetch_one(name, text, engine))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _prefetch_one(self, name: str, text: str, engine):
+        try:
+            await engine.synthesize(text)
+        except Exception as e:
+            print(f"[TTS prefetch] errore prompt '{name}':", e)
+            return
+        with self._lock:
+            self._keys[name] = engine.text_key(text)
+
+    def forget(self, call_sid: str):
+        """Chiamata finita: i suoi prompt attesi non arriveranno più."""
+        with self._lock:
+            self._expected.pop(call_sid, None)
+
+    def record_served(self, text: str, cached: bool):
+        """Conta hit/miss del prefetch quando Twilio chiede l'audio di un prompt atteso.
+        La richiesta audio non dice di che chiamata è: vale la prima che aspetta quel prompt,
+        e quel suo turno si considera servito."""
+        name = self._names.get(text)
+        if not name:
+            return
+        with self._lock:
+            turn = next((t for turns in self._expected.values() for t in turns if name in t), None)
+            if turn is None:
+                return
+            turn.clear()
+            if cached:
+                self.prefetch_hits += 1
+            else:
+                self.prefetch_misses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            served = self.prefetch_hits + self.prefetch_misses
+            return {
+                "prompts": len(self.prompts),
+                "ready": len(self._keys),
+                "prefetch": {
+                    "started": self.prefetch_started,
+                    "in_flight": len(self._tasks),
+                    "waiting_calls": len(self._expected),
+                    "hits": self.prefetch_hits,
+                    "misses": self.prefetch_misses,
+                    "hit_rate": round(self.prefetch_hits / served, 3) if served else 0.0,
+                },
+            }
@@ -0,0 +1,547 @@
+import os
+import re
+import time
+import struct
+import asyncio
+import threading
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import httpx
+
+import tts_local_worker
+from tts_cache import TTSCache
+from metrics import LatencyStats
+
+# =========================
+# Provider TTS asincroni
+# =========================
+ELEVEN_TTS_TIMEOUT = float(os.getenv("ELEVEN_TTS_TIMEOUT", "10"))
+GOOGLE_TTS_TIMEOUT = float(os.getenv("GOOGLE_TTS_TIMEOUT", "8"))
+TTS_MAX_CONCURRENCY = int(os.getenv("TTS_MAX_CONCURRENCY", "8"))
+
+# Coqui TTS locale (fallback senza cloud)
+TTS_LOCAL_MODEL = os.getenv("TTS_LOCAL_MODEL", "tts_models/multilingual/multi-dataset/xtts_v2")
+TTS_LOCAL_TIMEOUT = float(os.getenv("TTS_LOCAL_TIMEOUT", "30"))
+# Processi del pool Coqui (ognuno carica il suo modello) e warm-up all'avvio
+TTS_LOCAL_WORKERS = int(os.getenv("TTS_LOCAL_WORKERS", "1"))
+TTS_LOCAL_WARMUP = os.getenv("TTS_LOCAL_WARMUP", "1") == "1"
+
+# Pool HTTP verso ElevenLabs (keep-alive, niente handshake TLS ad ogni prompt)
+ELEVEN_POOL_SIZE = int(os.getenv("ELEVEN_POOL_SIZE", "10"))
+ELEVEN_MAX_RETRIES = int(os.getenv("ELEVEN_MAX_RETRIES", "2"))
+ELEVEN_RETRY_BACKOFF = float(os.getenv("ELEVEN_RETRY_BACKOFF", "0.25"))
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Profilo audio in uscita da /tts:
+#   hifi          -> qualità piena (MP3 44.1 kHz ElevenLabs, WAV LINEAR16 24 kHz Google)
+#   telephony     -> WAV μ-law 8 kHz, già nel formato della linea telefonica (Twilio non transcodifica)
+#   telephony_mp3 -> MP3 a bitrate basso
+TTS_OUTPUT_PROFILE = os.getenv("TTS_OUTPUT_PROFILE", "hifi").strip().lower()
+
+# profilo -> (output_format ElevenLabs, encoding per la cache key, media type)
+ELEVEN_OUTPUT_PROFILES = {
+    "hifi": (None, "mp3", "audio/mpeg"),  # default API = mp3_44100_128
+    "telephony": ("ulaw_8000", "ulaw_8000", "audio/wav"),
+    "telephony_mp3": ("mp3_22050_32", "mp3_22050_32", "audio/mpeg"),
+}
+# profilo -> (AudioEncoding Google, sample rate, media type)
+GOOGLE_OUTPUT_PROFILES = {
+    "hifi": ("LINEAR16", None, "audio/wav"),
+    "telephony": ("MULAW", 8000, "audio/wav"),  # Google restituisce già l'header WAV
+    "telephony_mp3": ("MP3", None, "audio/mpeg"),  # 32 kbps
+}
+
+try:
+    import h2  # noqa: F401  (pip install httpx[http2])
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class TTSError(Exception):
+    """Errore di sintesi; status_code è quello da restituire a Twilio."""
+
+    def __init__(self, detail: str, status_code: int = 502):
+        super().__init__(detail)
+        self.status_code = status_code
+
+
+class TTSBusy(TTSError):
+    """Provider saturo (es. tutti i worker Coqui occupati): si passa al successivo, non è un guasto."""
+
+    def __init__(self, detail: str):
+        super().__init__(detail, status_code=503)
+
+
+class ElevenLabsTTS:
+    name = "elevenlabs"
+
+    def __init__(self, api_key: str, voice_id: str, model_id: str = "eleven_multilingual_v2",
+                 timeout: float = ELEVEN_TTS_TIMEOUT, pool_size: int = ELEVEN_POOL_SIZE,
+                 max_retries: int = ELEVEN_MAX_RETRIES, profile: str = TTS_OUTPUT_PROFILE):
+        if profile not in ELEVEN_OUTPUT_PROFILES:
+            raise ValueError(f"TTS_OUTPUT_PROFILE non valido: {profile}")
+        self.profile = profile
+        self.output_format, self.encoding, self.media_type = ELEVEN_OUTPUT_PROFILES[profile]
+        self.api_key = api_key
+        self.voice_id = voice_id
+        self.model_id = model_id
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.retries = 0
+        self._client = None
+
+    def cache_key(self, text: str) -> str:
+        return TTSCache.make_key(self.name, f"{self.voice_id}/{self.model_id}", "it-IT", self.encoding, text)
+
+    async def start(self):
+        """Crea il client condiviso (da chiamare all'avvio dell'app)."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url="https://api.elevenlabs.io",
+                http2=HTTP2_AVAILABLE,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                    keepalive_expiry=60,
+                ),
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def synthesize(self, text: str) -> bytes:
+        if not self.api_key:
+            raise TTSError("ELEVEN_API_KEY mancante", status_code=500)
+
+        client = await self.start()
+        headers = {
+            "xi-api-key": self.api_key,
+            "Accept": "audio/mpeg",
+            "Content-Type": "application/json",
+        }
+        payload = {
+            "text": text,
+            "model_id": self.model_id,
+            "voice_settings": {"stability": 0.5, "similarity_boost": 0.8}
+        }
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            # backoff esponenziale, rispettando Retry-After se presente
+            delay = ELEVEN_RETRY_BACKOFF * (2 ** attempt)
+            try:
+                r = await client.post(f"/v1/text-to-speech/{self.voice_id}", headers=headers, json=payload,
+                                      params=self._params())
+            except httpx.TransportError as e:
+                if last:
+                    raise TTSError(f"Errore connessione ElevenLabs: {e}")
+            else:
+                if r.status_code == 200:
+                    if self.output_format == "ulaw_8000":
+                        return mulaw_wav_header(len(r.content)) + r.content
+                    return r.content
+                if r.status_code not in RETRY_STATUS or last:
+                    raise TTSError(f"Errore ElevenLabs: {r.status_code} - {r.text[:200]}")
+                try:
+                    delay = max(delay, float(r.headers.get("Retry-After", 0)))
+                except ValueError:
+                    pass
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    async def stream(self, text: str):
+        """Endpoint /stream di ElevenLabs: i chunk MP3 arrivano mentre la sintesi prosegue."""
+        if not self.api_key:
+            raise TTSError("ELEVEN_API_KEY mancante", status_code=500)
+
+        client = await self.start()
+        headers = {
+            "xi-api-key": self.api_key,
+            "Accept": "audio/mpeg",
+            "Content-Type": "application/json",
+        }
+        payload = {
+            "text": text,
+            "model_id": self.model_id,
+            "voice_settings": {"stability": 0.5, "similarity_boost": 0.8}
+        }
+        try:
+            async with client.stream("POST", f"/v1/text-to-speech/{self.voice_id}/stream",
+                                     headers=headers, json=payload, params=self._params()) as r:
+                if r.status_code != 200:
+                    body = await r.aread()
+                    raise TTSError(f"Errore ElevenLabs: {r.status_code} - {body[:200]!r}")
+                first = True
+                async for chunk in r.aiter_bytes():
+                    if not chunk:
+                        continue
+                    if first and self.output_format == "ulaw_8000":
+                        # μ-law grezzo: serve un header WAV perché Twilio lo riproduca
+                        chunk = mulaw_wav_header(None) + chunk
+                    first = False
+                    yield chunk
+        except httpx.TransportError as e:
+            raise TTSError(f"Errore connessione ElevenLabs: {e}")
+
+    def join_chunks(self, chunks: list) -> bytes:
+        audio = b"".join(chunks)
+        if self.output_format == "ulaw_8000":
+            offset = wav_data_offset(audio)
+            return mulaw_wav_header(len(audio) - offset) + audio[offset:]
+        # frame MP3 concatenati = MP3 valido
+        return audio
+
+    def _params(self) -> dict:
+        return {"output_format": self.output_format} if self.output_format else {}
+
+    def stats(self) -> dict:
+        return {
+            "profile": self.profile,
+            "http2": HTTP2_AVAILABLE,
+            "pool_size": self.pool_size,
+            "retries": self.retries,
+        }
+
+
+class GoogleTTS:
+    name = "google"
+
+    def __init__(self, language_code: str = "it-IT", timeout: float = GOOGLE_TTS_TIMEOUT,
+                 profile: str = TTS_OUTPUT_PROFILE):
+        # import qui: google-cloud-texttospeech serve solo se si usa questo provider
+        from google.cloud import texttospeech
+        if profile not in GOOGLE_OUTPUT_PROFILES:
+            raise ValueError(f"TTS_OUTPUT_PROFILE non valido: {profile}")
+        self.profile = profile
+        self.encoding, self.sample_rate, self.media_type = GOOGLE_OUTPUT_PROFILES[profile]
+        self._tts = texttospeech
+        self.language_code = language_code
+        self.timeout = timeout
+        self._client = None  # creato dentro l'event loop (gRPC asyncio)
+
+    def cache_key(self, text: str) -> str:
+        encoding = self.encoding if not self.sample_rate else f"{self.encoding}_{self.sample_rate}"
+        return TTSCache.make_key(self.name, "FEMALE", self.language_code, encoding, text)
+
+    async def start(self):
+        if self._client is None:
+            self._client = self._tts.TextToSpeechAsyncClient()
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.transport.close()
+            self._client = None
+
+    async def synthesize(self, text: str) -> bytes:
+        tts = self._tts
+        await self.start()
+
+        response = await self._client.synthesize_speech(
+            input=tts.SynthesisInput(text=text),
+            voice=tts.VoiceSelectionParams(
+                language_code=self.language_code,
+                ssml_gender=tts.SsmlVoiceGender.FEMALE
+            ),
+            audio_config=self._audio_config(),
+            timeout=self.timeout,
+        )
+        return response.audio_content
+
+    def _audio_config(self):
+        tts = self._tts
+        config = {"audio_encoding": getattr(tts.AudioEncoding, self.encoding)}
+        if self.sample_rate:
+            config["sample_rate_hertz"] = self.sample_rate
+        return tts.AudioConfig(**config)
+
+    async def stream(self, text: str):
+        """Google non ha streaming sul REST classico: sintetizza frase per frase
+        (in parallelo) e manda i pezzi in ordine appena pronti."""
+        sentences = [p for p in SENTENCE_SPLIT.split(text.strip()) if p] or [text]
+        tasks = [asyncio.ensure_future(self.synthesize(p)) for p in sentences]
+        try:
+            for i, task in enumerate(tasks):
+                wav = await task
+                if self.media_type != "audio/wav":
+                    yield wav  # MP3: i pezzi si concatenano così come sono
+                    continue
+                offset = wav_data_offset(wav)
+                if i == 0:
+                    # header "streaming": dimensione ignota fino alla fine
+                    yield wav_with_data_size(wav[:offset], None) + wav[offset:]
+                else:
+                    yield wav[offset:]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def join_chunks(self, chunks: list) -> bytes:
+        audio = b"".join(chunks)
+        if self.media_type != "audio/wav":
+            return audio
+        offset = wav_data_offset(audio)
+        return wav_with_data_size(audio[:offset], len(audio) - offset) + audio[offset:]
+
+    def stats(self) -> dict:
+        return {"profile": self.profile}
+
+
+class LocalTTS:
+    """Coqui TTS in locale: voce di riserva quando nessun TTS cloud risponde.
+
+    Modello e sintesi stanno in un pool di processi (TTS_LOCAL_WORKERS) creato alla
+    prima richiesta o dal warm-up in background: la CPU del worker uvicorn resta libera
+    e l'event loop non si blocca. Un job abbandonato (timeout, hedge perso) continua
+    nel pool e resta contato in pending finché non finisce: con tutti i worker occupati
+    le nuove richieste vengono rifiutate (TTSBusy) invece di accodarsi senza limite.
+    Esce sempre WAV PCM.
+    """
+    name = "local"
+    media_type = "audio/wav"
+    encoding = "wav"
+
+    def __init__(self, model_name: str = TTS_LOCAL_MODEL, timeout: float = TTS_LOCAL_TIMEOUT,
+                 workers: int = TTS_LOCAL_WORKERS, warm_up: bool = TTS_LOCAL_WARMUP):
+        self.model_name = model_name
+        self.timeout = timeout
+        self.workers = workers
+        self.warm_up = warm_up
+        self.profile = "wav"
+        self.available = importlib.util.find_spec("TTS") is not None
+        self._pool = None
+        self._lock = threading.Lock()
+        self._warm_task = None
+        self.ready = False
+        self.jobs = 0
+        self.pending = 0
+        self.latency = LatencyStats()
+
+    def cache_key(self, text: str) -> str:
+        return TTSCache.make_key(self.name, self.model_name, "it", self.encoding, text)
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # spawn: niente fork di un processo con event loop e thread già avviati
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=tts_local_worker.init,
+                    initargs=(self.model_name,),
+                )
+            return self._pool
+
+    def _reset(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self.ready = False
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    async def start(self):
+        if not self.available:
+            print("[Local TTS] Coqui TTS non installato (pip install TTS), provider disattivato")
+            return
+        if self.warm_up:
+            self._warm_task = asyncio.create_task(self._warm())
+
+    async def _warm(self):
+        loop = asyncio.get_running_loop()
+        pool = self._executor()
+        try:
+            # un job per processo: il caricamento è lento, quindi ognuno finisce su un worker diverso
+            took = await asyncio.gather(*[
+                loop.run_in_executor(pool, tts_local_worker.warm_up) for _ in range(self.workers)
+            ])
+        except Exception as e:
+            print("[Local TTS] Warm-up fallito:", e)
+            return
+        self.ready = True
+        print(f"[Local TTS] {self.workers} worker pronti in {max(took):.1f}s")
+
+    async def aclose(self):
+        if self._warm_task:
+            self._warm_task.cancel()
+        self._reset()
+
+    async def synthesize(self, text: str) -> bytes:
+        if not self.available:
+            raise TTSError("Coqui TTS non installato (pip install TTS)", status_code=503)
+        started = time.perf_counter()
+        with self._lock:
+            if self.pending >= self.workers:
+                raise TTSBusy(f"Coqui TTS occupato ({self.pending} job in corso)")
+            self.pending += 1
+        try:
+            job = self._executor().submit(tts_local_worker.synthesize, text)
+        except BrokenProcessPool:
+            self._job_done(None)
+            self._reset()
+            raise TTSError("Worker Coqui TTS terminato", status_code=503)
+        # pending scende quando il processo ha davvero finito, non quando chi aspetta rinuncia
+        job.add_done_callback(self._job_done)
+        try:
+            audio = await asyncio.wrap_future(job)
+        except BrokenProcessPool:
+            # un worker è morto (es. OOM): il pool verrà ricreato alla prossima richiesta
+            self._reset()
+            raise TTSError("Worker Coqui TTS terminato", status_code=503)
+        self.jobs += 1
+        self.latency.add(time.perf_counter() - started)
+        return audio
+
+    def _job_done(self, _job):
+        with self._lock:
+            self.pending -= 1
+
+    async def stream(self, text: str):
+        yield await self.synthesize(text)
+
+    def join_chunks(self, chunks: list) -> bytes:
+        return b"".join(chunks)
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model_name,
+            "available": self.available,
+            "workers": self.workers,
+            "pool_started": self._pool is not None,
+            "ready": self.ready,
+            "jobs": self.jobs,
+            "pending": self.pending,
+            "latency": self.latency.stats(),
+        }
+
+
+# ---------- WAV helpers (per unire i pezzi sintetizzati frase per frase) ----------
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+")
+
+
+def wav_data_offset(wav: bytes) -> int:
+    """Offset del primo byte audio dopo il chunk 'data' (0 se non è un WAV)."""
+    if wav[:4] != b"RIFF":
+        return 0
+    i = wav.find(b"data", 12)
+    return i + 8 if i >= 0 else 0
+
+
+def wav_with_data_size(header: bytes, data_size) -> bytes:
+    """Riscrive le dimensioni RIFF/data di un header WAV (None = lunghezza ignota, per lo streaming)."""
+    if len(header) < 12:
+        return header
+    if data_size is None:
+        riff_size = data_size = 0xFFFFFFFF
+    else:
+        riff_size = len(header) - 8 + data_size
+    return header[:4] + struct.pack("<I", riff_size) + header[8:-4] + struct.pack("<I", data_size)
+
+
+def mulaw_wav_header(data_size, sample_rate: int = 8000) -> bytes:
+    """Header WAV per μ-law mono 8 bit (WAVE_FORMAT_MULAW = 7). None = lunghezza ignota."""
+    size = 0xFFFFFFFF if data_size is None else data_size
+    riff_size = 0xFFFFFFFF if data_size is None else 4 + 26 + 12 + 8 + data_size
+    return (
+        b"RIFF" + struct.pack("<I", riff_size) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHHH", 18, 7, 1, sample_rate, sample_rate, 1, 8, 0)
+        + b"fact" + struct.pack("<II", 4, size)
+        + b"data" + struct.pack("<I", size)
+    )
+
+
+# Limite globale di sintesi in parallelo (per processo)
+tts_semaphore = asyncio.Semaphore(TTS_MAX_CONCURRENCY)
+
+
+async def synthesize_bounded(provider, text: str) -> bytes:
+    """Sintesi con semaforo di concorrenza e timeout del provider."""
+    async with tts_semaphore:
+        try:
+            return await asyncio.wait_for(provider.synthesize(text), provider.timeout)
+        except asyncio.TimeoutError:
+            raise TTSError(f"Timeout {provider.name} dopo {provider.timeout}s", status_code=504)
+
+
+class TTSStream:
+    """Stream già aperto (slot del semaforo preso, primo chunk arrivato), da passare a StreamingResponse.
+
+    aclose() libera slot e stream del provider anche se l'iterazione non è mai partita
+    (es. Twilio chiude prima dell'header): va chiamata sempre, a fine risposta.
+    A stream completo l'audio intero va a on_complete; on_close viene chiamata una volta alla fine.
+    """
+
+    def __init__(self, provider, source, first: bytes, on_complete, on_close=None):
+        self.provider = provider
+        self._source = source
+        self._chunks = [first]
+        self._on_complete = on_complete
+        self._on_close = on_close
+        self._body = self._iterate()
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._body.__anext__()
+
+    async def _iterate(self):
+        complete = False
+        try:
+            yield self._chunks[0]
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(self._source.__anext__(), self.provider.timeout)
+                except StopAsyncIteration:
+                    break
+                self._chunks.append(chunk)
+                yield chunk
+            complete = True
+        except Exception as e:
+            print(f"ERRORE streaming TTS ({self.provider.name}):", e)
+        finally:
+            await self._release(complete)
+
+    async def _release(self, complete: bool = False):
+        if self._closed:
+            return
+        self._closed = True
+        tts_semaphore.release()
+        try:
+            await self._source.aclose()
+            if complete:
+                self._on_complete(self.provider.join_chunks(self._chunks))
+        finally:
+            if self._on_close:
+                self._on_close()
+
+    async def aclose(self):
+        await self._body.aclose()  # iterazione partita: passa dal finally di _iterate
+        await self._release()  # mai partita
+
+
+async def open_stream(provider, text: str, on_complete, ttfb, started: float, on_close=None) -> TTSStream:
+    """Avvia lo streaming e attende il primo chunk (così gli errori iniziali diventano
+    ancora un HTTP 5xx). Ritorna un TTSStream da passare a StreamingResponse."""
+    await tts_semaphore.acquire()
+    source = provider.stream(text)
+    try:
+        first = await asyncio.wait_for(source.__anext__(), provider.timeout)
+    except asyncio.TimeoutError:
+        tts_semaphore.release()
+        await source.aclose()
+        raise TTSError(f"Timeout {provider.name} dopo {provider.timeout}s", status_code=504)
+    except BaseException:
+        tts_semaphore.release()
+        await source.aclose()
+        raise
+    ttfb.add(time.perf_counter() - started)
+    return TTSStream(provider, source, first, on_complete, on_close)
@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+from metrics import LatencyStats
+
+# =========================
+# Coda eventi Stripe (SQLite) + pool di worker per il fulfillment
+# =========================
+WEBHOOK_DB = Path(os.getenv("WEBHOOK_DB", "data/stripe_events.db"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8"))
+WEBHOOK_BACKOFF = float(os.getenv("WEBHOOK_BACKOFF", "2"))
+WEBHOOK_BACKOFF_MAX = float(os.getenv("WEBHOOK_BACKOFF_MAX", "300"))
+# Un evento preso da un worker morto (crash, riavvio) torna disponibile dopo WEBHOOK_LEASE secondi
+WEBHOOK_LEASE = float(os.getenv("WEBHOOK_LEASE", "120"))
+# Dedup: gli id degli eventi processati si tengono WEBHOOK_DEDUP_TTL secondi (Stripe ritenta per 3 giorni),
+# gli eventi completati in tabella WEBHOOK_DONE_TTL; la pulizia gira ogni WEBHOOK_COMPACT_INTERVAL
+WEBHOOK_DEDUP_TTL = float(os.getenv("WEBHOOK_DEDUP_TTL", str(30 * 24 * 3600)))
+WEBHOOK_DONE_TTL = float(os.getenv("WEBHOOK_DONE_TTL", str(24 * 3600)))
+WEBHOOK_COMPACT_INTERVAL = float(os.getenv("WEBHOOK_COMPACT_INTERVAL", "3600"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY,
+    event_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at REAL NOT NULL,
+    last_error TEXT,
+    done_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_events_ready ON events(status, next_at);
+CREATE TABLE IF NOT EXISTS processed_events (
+    event_id TEXT PRIMARY KEY,
+    processed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_processed_at ON processed_events(processed_at);
+-- doppioni salvati prima dell'indice univoco: resta il primo
+DELETE FROM events WHERE seq NOT IN (SELECT MIN(seq) FROM events GROUP BY event_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_events_event_id ON events(event_id);
+"""
+
+
+class FulfillmentError(Exception):
+    """Errore definitivo (es. buyer inesistente): l'evento non viene ritentato."""
+
+
+class WebhookQueue:
+    """put() salva l'evento su SQLite (fsync) e ritorna: il webhook risponde 200 subito.
+    WEBHOOK_WORKERS thread prendono gli eventi e chiamano handler(event) con retry e
+    backoff esponenziale; dopo WEBHOOK_MAX_ATTEMPTS l'evento resta in tabella come 'failed'.
+
+    Stripe consegna "almeno una volta": un event_id già in coda o già processato
+    (indice processed_events, compattato dopo WEBHOOK_DEDUP_TTL) non viene accodato di nuovo.
+
+    Un evento viene preso con un lease: se il processo muore a metà, dopo WEBHOOK_LEASE
+    secondi torna disponibile (anche per un altro processo sullo stesso file).
+    """
+
+    def __init__(self, handler, path: Path = WEBHOOK_DB, workers: int = WEBHOOK_WORKERS,
+                 max_attempts: int = WEBHOOK_MAX_ATTEMPTS):
+        self.handler = handler
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # l'evento deve essere su disco prima di rispondere 200 a Stripe
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute("PRAGMA busy_timeout=10000")
+        self._db.executescript(SCHEMA)
+        self._threads = []
+        self._stop = False
+        self.in_flight = 0
+        self.done = 0
+        self.retries = 0
+        self.duplicates = 0
+        self._next_compact = 0.0
+        self.last_error = None
+        self.latency = LatencyStats()
+
+    # ---------- API ----------
+    def put(self, event: dict):
+        """Accoda l'evento e ritorna il suo seq; None se è un doppione (già in coda o già processato)."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                seen = self._db.execute(
+                    "SELECT 1 FROM processed_events WHERE event_id = ?", (event["id"],)).fetchone()
+                cur = None if seen else self._db.execute(
+                    "INSERT OR IGNORE INTO events (event_id, type, payload, received_at, next_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (event["id"], event["type"], json.dumps(event), now, now),
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            if cur is None or not cur.rowcount:
+                self.duplicates += 1
+                return None
+        with self._cond:
+            self._cond.notify()
+        return cur.lastrowid
+
+    def start(self):
+        """Avvia i worker; le chiamate successive non fanno niente (sicuro da più thread)."""
+        with self._cond:
+            if self._threads:
+                return
+            self._stop = False
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"webhook-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def running(self) -> bool:
+        return bool(self._threads)
+
+    def stop(self, timeout: float = 5):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    # ---------- worker ----------
+    def _claim(self):
+        """Prende il prossimo evento pronto (o con lease scaduto) in modo atomico."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT seq, payload, received_at, attempts FROM events "
+                    "WHERE status IN ('pending', 'working') AND next_at <= ? ORDER BY next_at LIMIT 1",
+                    (now,)).fetchone()
+                if row:
+                    self._db.execute(
+                        "UPDATE events SET status = 'working', next_at = ? WHERE seq = ?",
+                        (now + WEBHOOK_LEASE, row[0]))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return row
+
+    def _next_ready_in(self) -> float:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MIN(next_at) FROM events WHERE status IN ('pending', 'working')").fetchone()
+        return 1.0 if row[0] is None else min(max(row[0] - time.time(), 0.0), 1.0)
+
+    def compact(self):
+        """Pulizia TTL: eventi completati e id dell'indice di dedup troppo vecchi."""
+        now = time.time()
+        with self._lock:
+            done = self._db.execute(
+                "DELETE FROM events WHERE status = 'done' AND done_at < ?", (now - WEBHOOK_DONE_TTL,)).rowcount
+            seen = self._db.execute(
+                "DELETE FROM processed_events WHERE processed_at < ?", (now - WEBHOOK_DEDUP_TTL,)).rowcount
+        if done or seen:
+            print(f"[Webhook queue] pulizia: {done} eventi completati, {seen} id di dedup scaduti")
+
+    def _maybe_compact(self):
+        with self._lock:
+            if time.monotonic() < self._next_compact:
+                return
+            self._next_compact = time.monotonic() + WEBHOOK_COMPACT_INTERVAL
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"[Webhook queue] errore pulizia: {e}")
+
+    def _run(self):
+        while not self._stop:
+            self._maybe_compact()
+            try:
+                row = self._claim()
+            except Exception as e:
+                print(f"[Webhook queue] errore lettura coda: {e}")
+                row = None
+            if row is None:
+                with self._cond:
+                    if not self._stop:
+                        self._cond.wait(self._next_ready_in())
+                continue
+            try:
+                self._process(*row)
+            except Exception as e:
+                # esito non salvato: l'evento torna disponibile alla scadenza del lease
+                print(f"[Webhook queue] errore salvataggio esito evento {row[0]}: {e}")
+
+    def _process(self, seq: int, payload: str, received_at: float, attempts: int):
+        with self._lock:
+            self.in_flight += 1
+        event = json.loads(payload)
+        try:
+            self.handler(event)
+        except Exception as e:
+            attempts += 1
+            self.last_error = str(e)
+            final = isinstance(e, FulfillmentError) or attempts >= self.max_attempts
+            delay = min(WEBHOOK_BACKOFF * 2 ** (attempts - 1), WEBHOOK_BACKOFF_MAX)
+            if final:
+                print(f"[Webhook queue] evento {seq} lasciato come 'failed' dopo {attempts} tentativi:", e)
+            else:
+                print(f"[Webhook queue] evento {seq}: tentativo {attempts}/{self.max_attempts} fallito:", e)
+            with self._lock:
+                self._db.execute(
+                    "UPDATE events SET status = ?, attempts = ?, next_at = ?, last_error = ? WHERE seq = ?",
+                    ("failed" if final else "pending", attempts, time.time() + delay, str(e), seq))
+                if not final:
+                    self.retries += 1
+            return
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "UPDATE events SET status = 'done', attempts = ?, done_at = ? WHERE seq = ?",
+                    (attempts + 1, now, seq))
+                self._db.execute(
+                    "INSERT OR REPLACE INTO processed_events (event_id, processed_at) VALUES (?, ?)",
+                    (event["id"], now))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self.done += 1
+        self.latency.add(now - received_at)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._db.execute(
+                "SELECT status, COUNT(*) FROM events WHERE status != 'done' GROUP BY status").fetchall())
+            in_flight = self.in_flight
+            processed = self._db.execute("SELECT COUNT(*) FROM processed_events").fetchone()[0]
+        return {
+            "depth": counts.get("pending", 0) + counts.get("working", 0),
+            "in_flight": in_flight,
+            "failed": counts.get("failed", 0),
+            "done": self.done,
+            "retries": self.retries,
+            "duplicates": self.duplicates,
+            "dedup_index": processed,
+            "last_error": self.last_error,
+            "workers": len(self._threads),
+            "fulfillment_latency": self.latency.stats(),
+        }